@@ -0,0 +1,294 @@
+'''
+Benchmarks for the model and collection hot paths.
+
+Runs each benchmark over a range of document widths and collection sizes
+against the in-memory backend, and writes the results as json. Results can
+be compared against a stored baseline:
+
+    python benchmarks/benchmark.py --output baseline.json
+    ... upgrade ...
+    python benchmarks/benchmark.py --baseline baseline.json
+
+Exits with status 1 if any benchmark got slower than the baseline by more
+than --threshold.
+'''
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quickdata import Collection, Model, InMemoryBackend
+from quickdata.utils.cacheutils import memoize_with_expiry
+from quickdata.utils.idutils import SortableIdGenerator
+
+WIDTHS = [5, 50, 200]
+SIZES = [100, 10000]
+QUICK_WIDTHS = [5, 50]
+QUICK_SIZES = [100, 1000]
+
+
+## FIXTURES -------------------------------------------------------------------
+
+def make_classes(width):
+    fieldnames = ['f%d' % i for i in range(width)]
+
+    class BenchModel(Model):
+        fields = fieldnames
+        computed_fields = {'f0_twice': lambda self: self.f0 * 2}
+
+    class BenchCollection(Collection):
+        modelClass = BenchModel
+
+    return BenchModel, BenchCollection
+
+
+def make_data(width, i=0):
+    data = dict(('f%d' % f, i + f) for f in range(width))
+    data['group'] = i % 10
+    return data
+
+
+def make_collection(width, size, **backendArgs):
+    modelClass, collectionClass = make_classes(width)
+    collection = collectionClass()
+    collection.setBackend(InMemoryBackend, **backendArgs)
+    collection.saveMany([modelClass(**make_data(width, i))
+                         for i in range(size)])
+    return collection
+
+
+## BENCHMARKS -----------------------------------------------------------------
+#
+# Each benchmark takes its parameters and returns (fn, number): a function
+# running one operation and how many times to run it per measurement.
+
+BENCHMARKS = []
+
+
+def benchmark(*params):
+    def register(fn):
+        BENCHMARKS.append((fn.__name__, fn, params))
+        return fn
+    return register
+
+
+@benchmark('width')
+def model_getattr(width):
+    modelClass, collectionClass = make_classes(width)
+    model = modelClass(**make_data(width))
+    return lambda: model.f1, 100000
+
+
+@benchmark('width')
+def model_getattr_computed(width):
+    modelClass, collectionClass = make_classes(width)
+    model = modelClass(**make_data(width))
+    return lambda: model.f0_twice, 100000
+
+
+@benchmark('width')
+def model_getitem(width):
+    modelClass, collectionClass = make_classes(width)
+    model = modelClass(**make_data(width))
+    return lambda: model['f1'], 100000
+
+
+@benchmark('width')
+def model_todata(width):
+    collection = make_collection(width, 1)
+    model = iter(collection).next()
+    return lambda: model.toData(), 2000
+
+
+@benchmark('width')
+def model_todata_computed(width):
+    collection = make_collection(width, 1)
+    model = iter(collection).next()
+    return lambda: model.toData(include_computed=True), 2000
+
+
+@benchmark('width')
+def collection_todata_many(width):
+    collection = make_collection(width, 100)
+    models = list(collection)
+    return lambda: collection.toDataMany(models), 100
+
+
+@benchmark('width')
+def collection_hydrate(width):
+    collection = make_collection(width, 1)
+    data = collection.backend.iter().next()
+    return lambda: collection._modelFromData(data), 5000
+
+
+@benchmark('size')
+def collection_makeid_random(size):
+    collection = make_collection(5, size)
+    return lambda: collection.makeId(None), 20000
+
+
+@benchmark('size')
+def collection_makeid_sortable(size):
+    collection = make_collection(5, size,
+                                 idGenerator=SortableIdGenerator(node=1))
+    return lambda: collection.makeId(None), 20000
+
+
+@benchmark()
+def memoize_hit():
+    fn = memoize_with_expiry({}, expiry_time=300)(lambda key: key)
+    fn('key')
+    return lambda: fn('key'), 100000
+
+
+@benchmark()
+def memoize_miss():
+    fn = memoize_with_expiry({}, expiry_time=300)(lambda key: key)
+    keys = iter(xrange(10**9))
+    return lambda: fn(keys.next()), 100000
+
+
+@benchmark('width', 'size')
+def collection_save_new(width, size):
+    collection = make_collection(width, size)
+    modelClass = collection.modelClass
+    data = make_data(width)
+    return lambda: collection.add(modelClass(**data)), 500
+
+
+@benchmark('width', 'size')
+def collection_save_changed(width, size):
+    collection = make_collection(width, size)
+    model = iter(collection).next()
+    def save():
+        model.f1 += 1
+        model.save()
+    return save, 500
+
+
+@benchmark('width', 'size')
+def collection_find_scan(width, size):
+    collection = make_collection(width, size)
+    return lambda: list(collection.find({'group': 3}, limit=10)), 100
+
+
+@benchmark('width', 'size')
+def collection_find_indexed(width, size):
+    collection = make_collection(width, size, indexes={'group': 'hash'})
+    return lambda: list(collection.find({'group': 3}, limit=10)), 100
+
+
+@benchmark('width', 'size')
+def collection_scan(width, size):
+    collection = make_collection(width, size)
+    return lambda: sum(1 for model in collection.scan()), 10
+
+
+@benchmark('width', 'size')
+def collection_scan_records(width, size):
+    collection = make_collection(width, size)
+    return lambda: sum(1 for record in collection.scan(records=True)), 10
+
+
+@benchmark('width', 'size')
+def collection_get(width, size):
+    collection = make_collection(width, size)
+    modelId = iter(collection).next().id
+    return lambda: collection[modelId], 2000
+
+
+## RUNNER ---------------------------------------------------------------------
+
+def param_sets(params, widths, sizes):
+    sets = [{}]
+    for param in params:
+        values = widths if param == 'width' else sizes
+        sets = [dict(s, **{param: v}) for s in sets for v in values]
+    return sets
+
+
+def result_name(name, kwargs):
+    return name + ''.join('[%s=%s]' % (k, kwargs[k]) for k in sorted(kwargs))
+
+
+def run(widths, sizes, repeat, only=None):
+    results = {}
+    for name, fn, params in BENCHMARKS:
+        if only and not any(o in name for o in only):
+            continue
+        for kwargs in param_sets(params, widths, sizes):
+            op, number = fn(**kwargs)
+            best = min(timeit.repeat(op, repeat=repeat, number=number))
+            key = result_name(name, kwargs)
+            results[key] = dict(benchmark=name, params=kwargs,
+                                seconds_per_op=best / number)
+            sys.stderr.write('%-60s %12.3f us\n' % (key, best / number * 1e6))
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    Prints each result against the baseline. Returns the names of the
+    benchmarks that got slower by more than threshold (a ratio).
+    '''
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        old = baseline[key]['seconds_per_op']
+        new = results[key]['seconds_per_op']
+        ratio = new / old if old else float('inf')
+        flag = ''
+        if ratio > threshold:
+            flag = '  SLOWER'
+            regressions.append(key)
+        elif ratio < 1 / threshold:
+            flag = '  faster'
+        print('%-60s %12.3f us %12.3f us %7.2fx%s' % (key, old * 1e6,
+                                                     new * 1e6, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--output', help='write results as json to this file')
+    parser.add_argument('--baseline', help='json results to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown ratio counted as a regression')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer and smaller parameter values')
+    parser.add_argument('only', nargs='*',
+                        help='only run benchmarks whose names contain these')
+    args = parser.parse_args(argv)
+
+    widths, sizes = (QUICK_WIDTHS, QUICK_SIZES) if args.quick \
+                    else (WIDTHS, SIZES)
+    results = run(widths, sizes, args.repeat, args.only)
+    output = dict(meta=dict(python=platform.python_version(),
+                            platform=platform.platform(),
+                            date=datetime.datetime.utcnow().isoformat()+'Z'),
+                  results=results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    elif not args.baseline:
+        print(json.dumps(output, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
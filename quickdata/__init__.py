@@ -2,4 +2,7 @@
 
 from collection import *
 from model import *
+from record import *
 from backends.mongo import *
+from backends.memory import *
+from backends.sqlite import *
@@ -0,0 +1,231 @@
+__all__ = ['AsyncCollection']
+
+import trollius as asyncio
+from trollius import From, Return
+
+from collection import Collection, CollectionError
+from model import Model
+
+
+class AsyncCollection(Collection):
+    '''
+    A collection whose operations are asyncio coroutines, for use with an
+    asynchronous backend (see backends/asyncbase). Models are hydrated and
+    prepared for saving exactly as in Collection, but reads and writes go
+    through the coroutine methods below:
+
+    thing = yield From(Things().get(thingId))
+    thing.name = 'new name'
+    yield From(Things().save(thing))
+
+    cursor = Things().find({'name': 'new name'})
+    while (yield From(cursor.fetchNext())):
+        thing = cursor.nextObject()
+
+    The blocking Collection operations (indexing, len, in, del, scan and
+    Model.save/fetch/destroy) raise CollectionError. Models are always
+    loaded whole: partial models (Collection's fields argument) would have
+    to load their missing fields with a blocking call.
+    '''
+
+    def _sync(self, *args, **kwargs):
+        raise CollectionError("%s is asynchronous, use its coroutine methods" %
+                              self.__class__.__name__)
+
+    _do_add = _do_saveModel = _do_saveMany = _do_updateModel = _sync
+    _do_updateMany = _sync
+    _do_delete = _do_getItem = _do_getItems = _do_exists = _do_iter = _sync
+    _do_find = _do_scan = __len__ = __iter__ = _sync
+    # buffered writes are flushed from a thread, outside the event loop
+    setWriteBehind = _sync
+
+    def __nonzero__(self):
+        return True
+
+
+    @asyncio.coroutine
+    def _assignIds(self, models):
+        '''
+        Resolves to a dict mapping id(model) to a new id, for each model
+        that doesn't have an id yet.
+        '''
+        self._check_backend()
+        models = [model for model in models if not 'id' in model]
+        ids = self.backend.makeIds(models)
+        while models and not self._uniqueIds():
+            taken = yield From(self.backend.exists(ids))
+            if not taken and len(set(ids)) == len(ids):
+                break
+            seen = set()
+            for i in ids:
+                if i in seen:
+                    taken.add(i)
+                seen.add(i)
+            ids = [self.backend.makeId(model) if i in taken else i
+                   for model, i in zip(models, ids)]
+        raise Return(dict(zip(map(id, models), ids)))
+
+
+    @asyncio.coroutine
+    def get(self, modelId, default=None):
+        '''
+        Gets a model stored in this collection by modelId
+        '''
+        self._check_backend()
+        data = yield From(self.backend.getItem(modelId))
+        raise Return(self._modelFromData(data) if data else default)
+
+
+    @asyncio.coroutine
+    def getMany(self, modelIds, default=None):
+        '''
+        Gets many models at once, see Collection.getMany.
+        '''
+        self._check_backend()
+        modelIds = list(modelIds)
+        found = yield From(self.backend.getItems(modelIds))
+        result = []
+        for modelId in modelIds:
+            data = found.get(modelId)
+            result.append(self._modelFromData(data) if data else default)
+        raise Return(result)
+
+
+    @asyncio.coroutine
+    def exists(self, modelIdsOrModels):
+        self._check_backend()
+        result = yield From(self.backend.exists(map(self.toId,
+                                                    modelIdsOrModels)))
+        raise Return(result)
+
+
+    @asyncio.coroutine
+    def contains(self, modelOrId):
+        modelId = self.toId(modelOrId)
+        found = yield From(self.exists([modelId]))
+        raise Return(modelId in found)
+
+
+    @asyncio.coroutine
+    def save(self, model, full=False):
+        '''
+        Stores a model, giving it an id first if it doesn't have one. Like
+        Model.save, only changed keys are written unless full is set.
+        Resolves to the model's id.
+        '''
+        model._collection = self
+        if not model._needsSave(full):
+            raise Return(model['id'])
+        if full and model._partial:
+            self._check_backend()
+            data = yield From(self.backend.getItem(model['id']))
+            model._mergeMissing(data)
+        newIds = yield From(self._assignIds([model]))
+        model._savePrep(newIds.get(id(model)))
+        update = model._saveUpdate(full)
+        self._check_backend()
+        if update is None:
+            yield From(self.backend.saveModel(model))
+        else:
+            sets, unsets = update
+            yield From(self.backend.updateModel(model['id'], sets, unsets))
+        model._markClean()
+        raise Return(model['id'])
+
+
+    @asyncio.coroutine
+    def saveMany(self, models, full=False, **kwargs):
+        '''
+        Saves many models at once, see Collection.saveMany.
+        '''
+        models = list(models)
+        self._check_backend()
+        for model in models:
+            model._collection = self
+        changed = [model for model in models if model._needsSave(full)]
+        newIds = yield From(self._assignIds(changed))
+        whole = []
+        updates = []
+        for model in changed:
+            if full and model._partial:
+                data = yield From(self.backend.getItem(model['id']))
+                model._mergeMissing(data)
+            model._savePrep(newIds.get(id(model)))
+            update = model._saveUpdate(full)
+            if update is None:
+                whole.append(model)
+            else:
+                updates.append((model['id'],) + update)
+        if whole:
+            yield From(self.backend.saveMany(whole, **kwargs))
+        if updates:
+            yield From(self.backend.updateMany(updates, **kwargs))
+        for model in changed:
+            model._markClean()
+        raise Return([model['id'] for model in models])
+
+
+    @asyncio.coroutine
+    def add(self, model):
+        '''
+        Adds a model to this collection, saving it.
+        '''
+        if 'id' in model and (yield From(self.contains(model['id']))):
+            raise CollectionError("id %s already exists in collection" %\
+                                  model['id'])
+        yield From(self.save(model))
+        raise Return(model)
+
+
+    @asyncio.coroutine
+    def createClass(self, cls, *args, **kwargs):
+        newModel = cls(*args, **kwargs)
+        yield From(self.add(newModel))
+        raise Return(newModel)
+
+
+    @asyncio.coroutine
+    def create(self, *args, **kwargs):
+        newModel = yield From(self.createClass(self.modelClass, *args,
+                                               **kwargs))
+        raise Return(newModel)
+
+
+    @asyncio.coroutine
+    def delete(self, modelOrId):
+        '''
+        Removes a model from the collection. Raises KeyError if given an id
+        that isn't stored.
+        '''
+        model = modelOrId
+        if not isinstance(model, Model):
+            model = yield From(self.get(modelOrId))
+            if model is None:
+                raise KeyError(modelOrId)
+        self._check_backend()
+        yield From(self.backend.delete(model))
+
+
+    @asyncio.coroutine
+    def count(self):
+        self._check_backend()
+        result = yield From(self.backend.len())
+        raise Return(result)
+
+
+    def iter(self):
+        '''
+        Returns an AsyncCursor over every model in the collection.
+        '''
+        self._check_backend()
+        return self.backend.iter().map(self._modelFromData)
+
+
+    def find(self, query, limit=None):
+        '''
+        Returns an AsyncCursor over the models matching query, see
+        Collection.find.
+        '''
+        self._check_backend()
+        cursor = self.backend.find(query, limit=limit)
+        return cursor.map(self._modelFromData)
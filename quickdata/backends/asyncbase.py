@@ -0,0 +1,196 @@
+__all__ = ['AsyncBaseBackend', 'AsyncCursor', 'WrappedAsyncBackend',
+           'ThreadedAsyncBackend']
+
+import functools
+import itertools
+
+from collections import deque
+
+import trollius as asyncio
+from trollius import From, Return
+
+from ..utils.idutils import RandomIdGenerator
+
+
+class AsyncCursor(object):
+    '''
+    Iterates asynchronously over the results of a query. fetchBatch is a
+    callable returning a future (or coroutine) for the next list of results,
+    or for an empty list once there are no more:
+
+    while (yield From(cursor.fetchNext())):
+        model = cursor.nextObject()
+    '''
+
+    def __init__(self, fetchBatch, transform=None):
+        self.fetchBatch = fetchBatch
+        self.transform = transform
+        self.buffer = deque()
+        self.done = False
+
+    def map(self, transform):
+        '''
+        Returns a cursor over the same results that applies transform to
+        each of them.
+        '''
+        return AsyncCursor(self.fetchBatch, transform)
+
+    @asyncio.coroutine
+    def fetchNext(self):
+        '''
+        Resolves to True if a result is available from nextObject().
+        '''
+        if not self.buffer and not self.done:
+            batch = yield From(self.fetchBatch())
+            if batch:
+                self.buffer.extend(batch)
+            else:
+                self.done = True
+        raise Return(bool(self.buffer))
+
+    def nextObject(self):
+        data = self.buffer.popleft()
+        return self.transform(data) if self.transform else data
+
+    @asyncio.coroutine
+    def toList(self):
+        result = []
+        while (yield From(self.fetchNext())):
+            result.append(self.nextObject())
+        raise Return(result)
+
+
+class AsyncBaseBackend(object):
+    '''
+    Does nothing.
+
+    The asynchronous counterpart of BaseBackend. Operations return futures
+    (or coroutines) instead of results, except find and iter which return
+    an AsyncCursor. Id generation doesn't do I/O so it stays synchronous.
+    '''
+
+    def __init__(self, colName, idGenerator=None, *args, **kwargs):
+        self.colName = colName
+        self.idGenerator = idGenerator or RandomIdGenerator()
+        super(AsyncBaseBackend, self).__init__(*args, **kwargs)
+
+    def makeId(self, model):
+        return self.idGenerator.next_id()
+
+    def makeIds(self, models):
+        return self.idGenerator.next_ids(len(models))
+
+    def saveModel(self, model):
+        raise NotImplementedError()
+
+    def saveMany(self, models, **kwargs):
+        raise NotImplementedError()
+
+    def getItem(self, modelId):
+        raise NotImplementedError()
+
+    def getItems(self, modelIds, fields=None):
+        raise NotImplementedError()
+
+    def exists(self, modelIds):
+        raise NotImplementedError()
+
+    def updateModel(self, modelId, sets, unsets=None):
+        raise NotImplementedError()
+
+    def updateMany(self, updates, **kwargs):
+        raise NotImplementedError()
+
+    def delete(self, model):
+        raise NotImplementedError()
+
+    def len(self):
+        raise NotImplementedError()
+
+    def iter(self, fields=None):
+        raise NotImplementedError()
+
+    def find(self, query, limit=None, fields=None):
+        raise NotImplementedError()
+
+
+def _take(iterator, count):
+    return list(itertools.islice(iterator, count))
+
+
+class WrappedAsyncBackend(AsyncBaseBackend):
+    '''
+    Implements the asynchronous interface on top of a synchronous backend
+    of class backendClass. Subclasses decide how each blocking call is run
+    by implementing _call(fn, *args, **kwargs), which returns a future.
+    Cursors pull their results from the synchronous backend batchSize at a
+    time.
+    '''
+
+    backendClass = None
+    batchSize = 100
+
+    def __init__(self, colName, loop=None, **kwargs):
+        self.backend = self.backendClass(colName=colName, **kwargs)
+        self.loop = loop
+        super(WrappedAsyncBackend, self).__init__(colName,
+                                                  self.backend.idGenerator)
+
+    def _getLoop(self):
+        return self.loop or asyncio.get_event_loop()
+
+    def _call(self, fn, *args, **kwargs):
+        raise NotImplementedError()
+
+    def _cursor(self, results):
+        return AsyncCursor(lambda: self._call(_take, results, self.batchSize))
+
+    def saveModel(self, model):
+        return self._call(self.backend.saveModel, model)
+
+    def saveMany(self, models, **kwargs):
+        return self._call(self.backend.saveMany, models, **kwargs)
+
+    def getItem(self, modelId):
+        return self._call(self.backend.getItem, modelId)
+
+    def getItems(self, modelIds, fields=None):
+        return self._call(self.backend.getItems, modelIds, fields=fields)
+
+    def exists(self, modelIds):
+        return self._call(self.backend.exists, modelIds)
+
+    def updateModel(self, modelId, sets, unsets=None):
+        return self._call(self.backend.updateModel, modelId, sets, unsets)
+
+    def updateMany(self, updates, **kwargs):
+        return self._call(self.backend.updateMany, updates, **kwargs)
+
+    def delete(self, model):
+        return self._call(self.backend.delete, model)
+
+    def len(self):
+        return self._call(self.backend.len)
+
+    def iter(self, fields=None):
+        return self._cursor(self.backend.iter(fields=fields))
+
+    def find(self, query, limit=None, fields=None):
+        return self._cursor(self.backend.find(query, limit=limit,
+                                              fields=fields))
+
+
+class ThreadedAsyncBackend(WrappedAsyncBackend):
+    '''
+    Runs each call of the wrapped synchronous backend in an executor, so
+    blocking I/O never stalls the event loop. Uses the loop's default
+    executor unless one is given.
+    '''
+
+    def __init__(self, colName, executor=None, **kwargs):
+        self.executor = executor
+        super(ThreadedAsyncBackend, self).__init__(colName, **kwargs)
+
+    def _call(self, fn, *args, **kwargs):
+        return self._getLoop().run_in_executor(
+                    self.executor, functools.partial(fn, *args, **kwargs))
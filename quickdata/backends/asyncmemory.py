@@ -0,0 +1,22 @@
+__all__ = ['AsyncInMemoryBackend']
+
+import trollius as asyncio
+
+from asyncbase import WrappedAsyncBackend
+from memory import InMemoryBackend
+
+
+class AsyncInMemoryBackend(WrappedAsyncBackend):
+    '''
+    Asynchronous version of InMemoryBackend, mainly for tests. Calls never
+    block, so they run directly and return already completed futures.
+    '''
+    backendClass = InMemoryBackend
+
+    def _call(self, fn, *args, **kwargs):
+        future = asyncio.Future(loop=self._getLoop())
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
@@ -0,0 +1,20 @@
+__all__ = ['AsyncMongoBackend', 'AsyncCachedMongoBackend']
+
+from asyncbase import ThreadedAsyncBackend
+from mongo import MongoBackend, CachedMongoBackend
+
+
+class AsyncMongoBackend(ThreadedAsyncBackend):
+    '''
+    Implements an asynchronous collection using a mongo database backend.
+    pymongo calls are run in an executor; pass executor= to control how
+    many run at once. Other arguments are those of MongoBackend.
+    '''
+    backendClass = MongoBackend
+
+
+class AsyncCachedMongoBackend(ThreadedAsyncBackend):
+    '''
+    Asynchronous version of CachedMongoBackend.
+    '''
+    backendClass = CachedMongoBackend
@@ -1,16 +1,25 @@
 __all__ = ['BaseBackend']
 
+from ..utils.idutils import RandomIdGenerator
+
 class BaseBackend(object):
     '''
     Does nothing. 
+
+    New ids come from idGenerator (see utils/idutils), which defaults to
+    random ids.
     '''
 
-    def __init__(self, colName, *args, **kwargs):
+    def __init__(self, colName, idGenerator=None, *args, **kwargs):
         self.colName = colName
+        self.idGenerator = idGenerator or RandomIdGenerator()
         super(BaseBackend, self).__init__(*args, **kwargs)
 
     def makeId(self, model):
-        raise NotImplementedError()
+        return self.idGenerator.next_id()
+
+    def makeIds(self, models):
+        return self.idGenerator.next_ids(len(models))
 
     def add(self, model):
         raise NotImplementedError()
@@ -18,19 +27,43 @@ class BaseBackend(object):
     def saveModel(self, model):
         raise NotImplementedError()
 
+    def saveMany(self, models, batchSize=None, ordered=True):
+        return [self.saveModel(model) for model in models]
+
     def getItem(self, modelId):
         raise NotImplementedError()
 
+    def getItems(self, modelIds, fields=None):
+        items = ((modelId, self.getItem(modelId)) for modelId in modelIds)
+        return dict((modelId, data) for modelId, data in items if data)
+
+    def exists(self, modelIds):
+        return set(self.getItems(modelIds, fields=['id']))
+
+    def updateModel(self, modelId, sets, unsets=None):
+        raise NotImplementedError()
+
+    def updateMany(self, updates, batchSize=None, ordered=True):
+        '''
+        Applies many updates, each a (modelId, sets, unsets) tuple as taken
+        by updateModel.
+        '''
+        for modelId, sets, unsets in updates:
+            self.updateModel(modelId, sets, unsets)
+
     def delete(self, model):
         raise NotImplementedError()
 
     def len(self):
         raise NotImplementedError()
 
-    def iter(self):
+    def iter(self, fields=None):
+        raise NotImplementedError()
+
+    def find(self, query, limit=None, fields=None):
         raise NotImplementedError()
 
-    def find(self, query, limit=None):
+    def scan(self, query, batchSize=1000, startAfter=None, fields=None):
         raise NotImplementedError()
 
 
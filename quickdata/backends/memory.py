@@ -0,0 +1,390 @@
+__all__ = ['InMemoryBackend']
+
+import itertools
+import threading
+
+from bisect import bisect_left, bisect_right
+from copy import deepcopy
+from ..utils import queryutils
+
+from base import BaseBackend
+
+
+## INDEXES --------------------------------------------------------------------
+
+class HashIndex(object):
+    '''
+    Maps each hashable value of a field to the set of ids having that value.
+    Answers equality and $in conditions.
+    '''
+
+    def __init__(self, field):
+        self.field = field
+        self.values = {}
+
+    def _keys(self, data):
+        for value in queryutils._candidates(queryutils.get_path(data,
+                                                                self.field)):
+            try:
+                hash(value)
+            except TypeError:
+                continue
+            yield value
+
+    def add(self, modelId, data):
+        for value in self._keys(data):
+            self.values.setdefault(value, set()).add(modelId)
+
+    def remove(self, modelId, data):
+        for value in self._keys(data):
+            ids = self.values.get(value)
+            if ids is not None:
+                ids.discard(modelId)
+                if not ids:
+                    del self.values[value]
+
+    def _equal(self, value):
+        try:
+            return self.values.get(value, set())
+        except TypeError:
+            return None
+
+    def lookup(self, cond):
+        '''
+        Returns the set of ids that may match cond, or None if this index
+        can't answer it.
+        '''
+        if not queryutils.is_operator_dict(cond):
+            if cond is None or isinstance(cond, (dict, list)) or \
+               queryutils.is_regex(cond):
+                return None
+            return self._equal(cond)
+        result = None
+        for op, arg in cond.iteritems():
+            if op == '$eq' and arg is not None:
+                ids = self._equal(arg)
+            elif op == '$in' and None not in arg:
+                ids = set()
+                for value in arg:
+                    found = self._equal(value)
+                    if found is None:
+                        return None
+                    ids |= found
+            else:
+                continue
+            if ids is None:
+                return None
+            result = ids if result is None else result & ids
+        return result
+
+
+class SortedIndex(object):
+    '''
+    Keeps the orderable values of a field in sorted order so that equality,
+    $in and range conditions are answered with a binary search.
+    '''
+
+    def __init__(self, field):
+        self.field = field
+        self.keys = []
+        self.ids = []
+
+    def _keys(self, data):
+        for value in queryutils._candidates(queryutils.get_path(data,
+                                                                self.field)):
+            rank = queryutils.type_rank(value)
+            if rank is not None:
+                yield (rank, value)
+
+    def add(self, modelId, data):
+        for key in self._keys(data):
+            pos = bisect_right(self.keys, key)
+            self.keys.insert(pos, key)
+            self.ids.insert(pos, modelId)
+
+    def remove(self, modelId, data):
+        for key in self._keys(data):
+            pos = bisect_left(self.keys, key)
+            while pos < len(self.keys) and self.keys[pos] == key:
+                if self.ids[pos] == modelId:
+                    del self.keys[pos]
+                    del self.ids[pos]
+                    break
+                pos += 1
+
+    def _range(self, lo, hi):
+        return set(self.ids[lo:hi])
+
+    def _equal(self, value):
+        rank = queryutils.type_rank(value)
+        if rank is None:
+            return None
+        key = (rank, value)
+        return self._range(bisect_left(self.keys, key),
+                           bisect_right(self.keys, key))
+
+    def lookup(self, cond):
+        '''
+        Returns the set of ids that may match cond, or None if this index
+        can't answer it.
+        '''
+        if not queryutils.is_operator_dict(cond):
+            return self._equal(cond)
+
+        result = None
+        rank = lo = hi = None
+        for op, arg in cond.iteritems():
+            if op in ('$gt', '$gte', '$lt', '$lte'):
+                argrank = queryutils.type_rank(arg)
+                if argrank is None or (rank is not None and argrank != rank):
+                    return None
+                rank = argrank
+                key = (rank, arg)
+                if op == '$gt':
+                    lo = max(lo, bisect_right(self.keys, key))
+                elif op == '$gte':
+                    lo = max(lo, bisect_left(self.keys, key))
+                elif op == '$lt':
+                    pos = bisect_left(self.keys, key)
+                    hi = pos if hi is None else min(hi, pos)
+                else:
+                    pos = bisect_right(self.keys, key)
+                    hi = pos if hi is None else min(hi, pos)
+            elif op == '$eq':
+                ids = self._equal(arg)
+                if ids is None:
+                    return None
+                result = ids if result is None else result & ids
+            elif op == '$in':
+                ids = set()
+                for value in arg:
+                    found = self._equal(value)
+                    if found is None:
+                        return None
+                    ids |= found
+                result = ids if result is None else result & ids
+
+        if rank is not None:
+            if lo is None:
+                lo = bisect_left(self.keys, (rank,))
+            if hi is None:
+                hi = bisect_left(self.keys, (rank + 1,))
+            ids = self._range(lo, hi) if lo < hi else set()
+            result = ids if result is None else result & ids
+        return result
+
+
+INDEX_TYPES = {
+    'hash': HashIndex,
+    'sorted': SortedIndex,
+}
+
+
+## BACKEND --------------------------------------------------------------------
+
+def _project(data, fields):
+    if fields is None:
+        return deepcopy(data)
+    return deepcopy(dict((k, v) for k, v in data.iteritems() if k in fields))
+
+
+class InMemoryBackend(BaseBackend):
+    '''
+    Implements a collection held entirely in process memory. Useful for
+    reference data that fits in RAM and for tests.
+
+    Documents are copied on the way in and out so that models never share
+    state with the store. find() understands the common mongo query
+    operators. Secondary indexes can be declared as a dict mapping a field
+    (dotted paths are allowed) to 'hash' or 'sorted':
+
+    Things().setBackend(InMemoryBackend, indexes={'name': 'hash',
+                                                  'age': 'sorted'})
+
+    Hash indexes answer equality and $in conditions, sorted indexes also
+    answer range conditions. find() uses the most selective index it can
+    and only scans the documents it returns.
+    '''
+
+    def __init__(self, colName, indexes=None, idGenerator=None):
+        self.docs = {}
+        self.indexes = {}
+        self.lock = threading.RLock()
+        for field, kind in (indexes or {}).iteritems():
+            self.addIndex(field, kind)
+        super(InMemoryBackend, self).__init__(colName, idGenerator)
+
+
+    def addIndex(self, field, kind='hash'):
+        '''
+        Declares a secondary index on field and builds it from the documents
+        already stored.
+        '''
+        with self.lock:
+            index = INDEX_TYPES[kind](field)
+            for modelId, data in self.docs.iteritems():
+                index.add(modelId, data)
+            self.indexes[field] = index
+
+
+    def _store(self, modelId, data):
+        old = self.docs.get(modelId)
+        if old is not None:
+            for index in self.indexes.itervalues():
+                index.remove(modelId, old)
+        if data is None:
+            self.docs.pop(modelId, None)
+        else:
+            self.docs[modelId] = data
+            for index in self.indexes.itervalues():
+                index.add(modelId, data)
+
+
+    def _candidates(self, query):
+        '''
+        Returns a set of ids that includes every document matching query,
+        or None if no index applies and all documents must be scanned.
+        '''
+        best = None
+        for key, cond in query.iteritems():
+            ids = None
+            if key == '$and':
+                for subquery in cond:
+                    found = self._candidates(subquery)
+                    if found is not None and (ids is None or
+                                              len(found) < len(ids)):
+                        ids = found
+            elif key == '$or':
+                ids = set()
+                for subquery in cond:
+                    found = self._candidates(subquery)
+                    if found is None:
+                        ids = None
+                        break
+                    ids |= found
+            elif key == 'id':
+                if queryutils.is_operator_dict(cond):
+                    if cond.keys() == ['$in']:
+                        ids = set(i for i in cond['$in'] if i in self.docs)
+                elif not isinstance(cond, (dict, list)) and \
+                     cond is not None and not queryutils.is_regex(cond):
+                    ids = set([cond]) if cond in self.docs else set()
+            elif key in self.indexes:
+                ids = self.indexes[key].lookup(cond)
+            if ids is not None and (best is None or len(ids) < len(best)):
+                best = ids
+        return best
+
+
+    # Backend functions -----------------------
+
+    def add(self, model):
+        '''
+        Adds a model to this collection. Relies on the super class' save
+        functionality to assign an id.
+        '''
+        return model.save()
+
+
+    def saveModel(self, model):
+        data = deepcopy(dict(model))
+        with self.lock:
+            self._store(data['id'], data)
+        return data['id']
+
+
+    def saveMany(self, models, batchSize=None, ordered=True):
+        with self.lock:
+            return [self.saveModel(model) for model in models]
+
+
+    def getItem(self, modelId):
+        try:
+            return deepcopy(self.docs[modelId])
+        except (KeyError, TypeError):
+            return None
+
+
+    def getItems(self, modelIds, fields=None):
+        result = {}
+        for modelId in modelIds:
+            try:
+                result[modelId] = _project(self.docs[modelId], fields)
+            except (KeyError, TypeError):
+                pass
+        return result
+
+
+    def exists(self, modelIds):
+        found = set()
+        for modelId in modelIds:
+            try:
+                if modelId in self.docs:
+                    found.add(modelId)
+            except TypeError:
+                pass
+        return found
+
+
+    def updateModel(self, modelId, sets, unsets=None):
+        with self.lock:
+            data = deepcopy(self.docs[modelId])
+            data.update(deepcopy(sets))
+            for key in unsets or ():
+                data.pop(key, None)
+            self._store(modelId, data)
+
+
+    def updateMany(self, updates, batchSize=None, ordered=True):
+        with self.lock:
+            for modelId, sets, unsets in updates:
+                self.updateModel(modelId, sets, unsets)
+
+
+    def delete(self, model):
+        with self.lock:
+            self._store(model.id, None)
+
+
+    def len(self):
+        return len(self.docs)
+
+
+    def iter(self, fields=None):
+        for data in self.docs.values():
+            yield _project(data, fields)
+
+
+    def find(self, query, limit=None, fields=None):
+        with self.lock:
+            ids = self._candidates(query)
+            if ids is None:
+                docs = self.docs.values()
+            else:
+                docs = [self.docs[modelId] for modelId in ids]
+            result = []
+            for data in docs:
+                if queryutils.match_query(query, data):
+                    result.append(_project(data, fields))
+                    if limit and len(result) >= limit:
+                        break
+        for data in result:
+            yield data
+
+
+    def scan(self, query, batchSize=1000, startAfter=None, fields=None):
+        with self.lock:
+            ids = self._candidates(query) if query else None
+            ids = sorted(self.docs if ids is None else ids)
+        pos = 0 if startAfter is None else bisect_right(ids, startAfter)
+        batch = []
+        for modelId in itertools.islice(ids, pos, None):
+            data = self.docs.get(modelId)
+            if data is None or not queryutils.match_query(query, data):
+                continue
+            batch.append(_project(data, fields))
+            if len(batch) >= batchSize:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
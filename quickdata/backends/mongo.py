@@ -1,13 +1,52 @@
-__all__ = ['MongoBackend', 'CachedMongoBackend']
+__all__ = ['MongoBackend', 'CachedMongoBackend', 'MongoClientRegistry', 
+           'clientRegistry']
 
-import string
+import itertools
+import os
+import threading
 
-from copy import copy
-from ..utils import randutils
-from ..utils.cacheutils import memoize_with_expiry
+from copy import deepcopy
+from time import time
+from ..utils import metricutils
+from ..utils.cacheutils import LRUCache, SingleFlight, Refresher
 
 from base import BaseBackend
 
+
+class MongoClientRegistry(object):
+    '''
+    Shares one MongoClient, and so one connection pool, between every 
+    backend connecting with the same uri and client options. pymongo clients
+    must not be used across a fork, so a forked child process starts with
+    an empty registry and makes its own clients.
+    '''
+
+    def __init__(self):
+        self._reset()
+
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.clients = {}
+        self.lock = threading.Lock()
+
+
+    def get(self, uri, **options):
+        if self.pid != os.getpid():
+            self._reset()
+        key = (uri, tuple(sorted(options.items())))
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                from pymongo import MongoClient
+                client = MongoClient(host=uri, **options)
+                self.clients[key] = client
+        return client
+
+
+clientRegistry = MongoClientRegistry()
+
+
 class MongoBackend(BaseBackend):
     '''
     Implements a collection using a mongo database backend. 
@@ -18,7 +57,9 @@ class MongoBackend(BaseBackend):
 
     def _id2idfield(self, data):
         if data and 'id' in data and self.idField != 'id':
-            data = copy(data)
+            # a plain dict, so models (and their change tracking) are left
+            # alone
+            data = dict(data)
             idval = data.pop('id')
             data[self.idField] = idval
         return data
@@ -26,37 +67,62 @@ class MongoBackend(BaseBackend):
 
     def _idfield2id(self, data):
         if data and self.idField in data and self.idField != 'id':
-            data = copy(data)
+            data = dict(data)
             idval = data.pop(self.idField)
             data['id'] = idval
         return data
 
 
+    def _projection(self, fields):
+        if fields is None:
+            return None
+        return dict((self.idField if f == 'id' else f, 1) for f in fields)
+
+
     def __init__(self, colName, 
                  mongo=None, host="localhost:27017", 
-                 user="", passwd="", dbName="collections"):
-
-        from pymongo import MongoClient
+                 user="", passwd="", dbName="collections", 
+                 idGenerator=None, clientOptions=None):
+        '''
+        Connects through a client shared with the other backends using the 
+        same server, database and clientOptions (passed to MongoClient, for 
+        example {'maxPoolSize': 50}), unless a mongo client is given.
+        '''
+        self.dbName = dbName
+        self.uri = None
+        self.clientOptions = clientOptions or {}
         if not mongo:
             auth = '%s:%s@' % (user, passwd) if user else ''
-            uri  = 'mongodb://' + auth + host + "/" + dbName
-            self.mongo = MongoClient(host=uri)
-        else:
-            self.mongo = mongo
-        self.dbName = dbName
-        super(MongoBackend, self).__init__(colName)
+            self.uri = 'mongodb://' + auth + host + "/" + dbName
+        self._mongo = mongo
+        self._pid = None
+        super(MongoBackend, self).__init__(colName, idGenerator)
 
 
-    # Backend functions -----------------------
+    def _connect(self):
+        # resolve the client and collection handle once per process
+        if self.uri:
+            self._mongo = clientRegistry.get(self.uri, **self.clientOptions)
+        self._collection = self._mongo[self.dbName][self.colName]
+        self._pid = os.getpid()
 
-    def makeId(self, model):
-        '''
-        Creates a random uuid for an Id.
-        '''
-        return unicode(randutils.gen_random_str(12, string.ascii_lowercase+\
-                                                string.digits))
+
+    @property
+    def mongo(self):
+        if self._pid != os.getpid():
+            self._connect()
+        return self._mongo
+
+
+    @property
+    def collection(self):
+        if self._pid != os.getpid():
+            self._connect()
+        return self._collection
 
 
+    # Backend functions -----------------------
+
     def add(self, model):
         '''
         Adds a model to this collection and the database. Relies on the 
@@ -67,7 +133,33 @@ class MongoBackend(BaseBackend):
 
     def saveModel(self, model):
         model = self._id2idfield(model)
-        return self.mongo[self.dbName][self.colName].save(model)
+        return self.collection.save(model)
+
+
+    def saveMany(self, models, batchSize=1000, ordered=True):
+        '''
+        Saves (upserts) many models using bulk writes of up to batchSize
+        models each. Returns the list of saved ids.
+        '''
+        collection = self.collection
+        ids = []
+        bulk = None
+        for model in models:
+            if bulk is None:
+                bulk = collection.initialize_ordered_bulk_op() if ordered \
+                       else collection.initialize_unordered_bulk_op()
+                count = 0
+            data = self._id2idfield(model)
+            bulk.find({self.idField: data[self.idField]}).upsert()\
+                .replace_one(data)
+            ids.append(data[self.idField])
+            count += 1
+            if batchSize and count >= batchSize:
+                bulk.execute()
+                bulk = None
+        if bulk is not None:
+            bulk.execute()
+        return ids
 
 
     def getItem(self, modelId):
@@ -75,27 +167,96 @@ class MongoBackend(BaseBackend):
         obviously this is quite inefficient. Later I should implement a simple
         cache to keep these accesses from hitting the db each time
         '''
-        model = self.mongo[self.dbName][self.colName].find_one(modelId)
+        model = self.collection.find_one(modelId)
         model = self._idfield2id(model)
         return model
 
 
+    def getItems(self, modelIds, fields=None):
+        '''
+        Fetches many documents with a single query. Returns a dict mapping
+        each id that was found to its data. If fields is given only those
+        fields are fetched.
+        '''
+        query = {self.idField: {'$in': list(modelIds)}}
+        result = {}
+        cursor = self.collection.find(query, self._projection(fields))
+        for data in cursor:
+            data = self._idfield2id(data)
+            result[data['id']] = data
+        return result
+
+
+    def exists(self, modelIds):
+        '''
+        Returns the set of the given ids that are stored, fetching only the 
+        ids from the database.
+        '''
+        query = {self.idField: {'$in': list(modelIds)}}
+        cursor = self.collection.find(query, {self.idField: 1})
+        return set(data[self.idField] for data in cursor)
+
+
+    def updateModel(self, modelId, sets, unsets=None):
+        '''
+        Updates only the given fields of a stored document.
+        '''
+        update = self._update(sets, unsets)
+        if update:
+            return self.collection.update({self.idField: modelId}, update)
+
+
+    def _update(self, sets, unsets):
+        update = {}
+        sets = dict((k, v) for k, v in sets.iteritems() if k != 'id')
+        if sets:
+            update['$set'] = sets
+        if unsets:
+            update['$unset'] = dict((k, '') for k in unsets)
+        return update
+
+
+    def updateMany(self, updates, batchSize=1000, ordered=True):
+        '''
+        Applies many (modelId, sets, unsets) updates using bulk writes of
+        up to batchSize updates each.
+        '''
+        collection = self.collection
+        bulk = None
+        for modelId, sets, unsets in updates:
+            update = self._update(sets, unsets)
+            if not update:
+                continue
+            if bulk is None:
+                bulk = collection.initialize_ordered_bulk_op() if ordered \
+                       else collection.initialize_unordered_bulk_op()
+                count = 0
+            bulk.find({self.idField: modelId}).update_one(update)
+            count += 1
+            if batchSize and count >= batchSize:
+                bulk.execute()
+                bulk = None
+        if bulk is not None:
+            bulk.execute()
+
+
     def delete(self, model):
-        return self.mongo[self.dbName][self.colName].remove(model.id)
+        return self.collection.remove(model.id)
 
 
     def len(self):
-        return self.mongo[self.dbName][self.colName].count()
+        return self.collection.count()
 
 
-    def iter(self):
-        for data in self.mongo[self.dbName][self.colName].find():
-            yield data
+    def iter(self, fields=None):
+        cursor = self.collection.find({}, self._projection(fields))
+        for data in cursor:
+            yield self._idfield2id(data)
 
 
-    def find(self, query, limit=None):
+    def find(self, query, limit=None, fields=None):
         query = self._id2idfield(query)
-        cursor = self.mongo[self.dbName][self.colName].find(query)
+        cursor = self.collection.find(query, self._projection(fields))
         if limit:
             cursor.limit(limit)
         for data in cursor:
@@ -103,14 +264,226 @@ class MongoBackend(BaseBackend):
             yield data
 
 
+    def scan(self, query, batchSize=1000, startAfter=None, fields=None):
+        '''
+        Yields the documents matching query in lists of up to batchSize, in 
+        id order. Each batch is a separate query for the ids after the last
+        one seen, so no cursor is held open between batches and a scan can
+        be resumed from any id.
+        '''
+        collection = self.collection
+        query = self._id2idfield(query)
+        projection = self._projection(fields)
+        while True:
+            page = query
+            if startAfter is not None:
+                after = {self.idField: {'$gt': startAfter}}
+                page = {'$and': [query, after]} if query else after
+            cursor = collection.find(page, projection)
+            cursor.sort(self.idField, 1).limit(batchSize)
+            batch = [self._idfield2id(data) for data in cursor]
+            if not batch:
+                return
+            yield batch
+            if len(batch) < batchSize:
+                return
+            startAfter = batch[-1]['id']
+
+
 class CachedMongoBackend(MongoBackend):
     '''
-    Implements a collection using a mongo database backend. 
+    Implements a collection using a mongo database backend, with a bounded
+    in-process cache of documents fetched by id. 
+
+    Each backend (and therefore each collection) has its own cache. Entries
+    expire after cachettl seconds, and the least recently used entries are
+    evicted once there are more than cachesize entries or they take up more
+    than roughly cachebytes bytes. Saves write through to the cache and
+    deletes invalidate it.
+
+    To share one cache between all the worker processes on a host, pass a
+    cacheutils.SharedCache as cache. Its own bounds and expiry then apply
+    instead of cachettl, cachesize and cachebytes.
+
+    The cache is safe to use from several threads. When threads miss the
+    same id at once, one of them reads it from the database and the others
+    wait for that read.
+
+    With refreshAhead set (a fraction of the ttl, like 0.8), an entry read
+    when it is older than that is reloaded by one of refreshWorkers
+    background threads, while the cached value is returned. At most
+    maxRefreshes reloads are queued at once. See refreshStats().
     '''
-    cache = {}
 
-    def __init__(self, cachettl=300, **kwargs):
+    def __init__(self, cachettl=300, cachesize=10000, cachebytes=None, 
+                 cache=None, refreshAhead=None, refreshWorkers=2,
+                 maxRefreshes=100, **kwargs):
         super(CachedMongoBackend, self).__init__(**kwargs)
-        wrapper = memoize_with_expiry(self.cache, expiry_time=cachettl)
-        self.getItem = wrapper(self.getItem)
+        if cache is not None:
+            self.cache = cache.namespace(self.colName)
+        else:
+            self.cache = LRUCache(max_entries=cachesize, max_bytes=cachebytes,
+                                  expiry_time=cachettl)
+        self.loads = SingleFlight()
+        self.refreshAfter = None
+        self.refresher = None
+        ttl = self.cache.expiry_time
+        if refreshAhead and ttl:
+            self.refreshAfter = ttl * refreshAhead
+            self.refresher = Refresher(refreshWorkers, maxRefreshes,
+                                       self.colName)
+        # bumped by every write, so a read that raced with a write doesn't
+        # put what it read in the cache
+        self._writes = itertools.count()
+        self._writeCount = 0
+        self._writeLock = threading.Lock()
+
+
+    def _written(self):
+        with self._writeLock:
+            self._writeCount = next(self._writes)
+
+
+    def _cacheLoaded(self, writeCount, modelId, data):
+        if not data:
+            return
+        data = deepcopy(data)
+        # checked and set under the lock, so a write can't come in between
+        with self._writeLock:
+            if writeCount == self._writeCount:
+                self.cache.set(modelId, data)
+
+
+    def _fromCache(self, modelIds):
+        '''
+        Looks ids up in the cache. Returns a dict mapping the ids found to
+        their data, and the list of ids that weren't found.
+        '''
+        start = time()
+        found = {}
+        missing = []
+        for modelId in modelIds:
+            entry = self.cache.getEntry(modelId)
+            if entry is None:
+                missing.append(modelId)
+                continue
+            found[modelId] = entry[0]
+            if self.refreshAfter is not None and \
+               start - entry[1] >= self.refreshAfter:
+                self.refresher.request(modelId, self._refresh, modelId)
+        if metricutils.sinks:
+            latency = time() - start
+            if found:
+                metricutils.emit('cache', self.colName, latency, len(found),
+                                 'hit')
+            if missing:
+                metricutils.emit('cache', self.colName, latency, 
+                                 len(missing), 'miss')
+        return found, missing
+
+
+    def saveModel(self, model):
+        result = super(CachedMongoBackend, self).saveModel(model)
+        self._written()
+        # a copy, so later changes to the model aren't seen by other readers
+        self.cache.set(model['id'], deepcopy(dict(model)))
+        return result
+
+
+    def saveMany(self, models, **kwargs):
+        ids = super(CachedMongoBackend, self).saveMany(models, **kwargs)
+        self._written()
+        for model in models:
+            self.cache.set(model['id'], deepcopy(dict(model)))
+        return ids
+
+
+    def _load(self, modelId):
+        writeCount = self._writeCount
+        data = super(CachedMongoBackend, self).getItem(modelId)
+        self._cacheLoaded(writeCount, modelId, data)
+        return data
+
 
+    def _refresh(self, modelId):
+        if not self.loads.do(modelId, self._load, modelId):
+            # deleted elsewhere
+            self.cache.delete(modelId)
+
+
+    def refreshStats(self):
+        '''
+        Returns counts of refresh-ahead reloads done, failed, dropped
+        because too many were queued and pending, or None if refresh-ahead
+        is off.
+        '''
+        if self.refresher is None:
+            return None
+        return self.refresher.stats()
+
+
+    def getItem(self, modelId):
+        # cached and single flight documents are shared, callers get copies
+        # so that changing a model in place doesn't change them
+        found, missing = self._fromCache([modelId])
+        if found:
+            return deepcopy(found[modelId])
+        return deepcopy(self.loads.do(modelId, self._load, modelId))
+
+
+    def getItems(self, modelIds, fields=None):
+        result, missing = self._fromCache(modelIds)
+        result = deepcopy(result)
+        if missing:
+            writeCount = self._writeCount
+            fetched = super(CachedMongoBackend, self).getItems(missing, 
+                                                               fields)
+            if fields is None:
+                for modelId, data in fetched.iteritems():
+                    self._cacheLoaded(writeCount, modelId, data)
+            result.update(fetched)
+        return result
+
+
+    def exists(self, modelIds):
+        cached, missing = self._fromCache(modelIds)
+        found = set(cached)
+        if missing:
+            found |= super(CachedMongoBackend, self).exists(missing)
+        return found
+
+
+    def updateModel(self, modelId, sets, unsets=None):
+        result = super(CachedMongoBackend, self).updateModel(modelId, sets,
+                                                             unsets)
+        self._written()
+        self._cacheUpdated(modelId, sets, unsets)
+        return result
+
+
+    def updateMany(self, updates, **kwargs):
+        updates = list(updates)
+        super(CachedMongoBackend, self).updateMany(updates, **kwargs)
+        self._written()
+        for modelId, sets, unsets in updates:
+            self._cacheUpdated(modelId, sets, unsets)
+
+
+    def _cacheUpdated(self, modelId, sets, unsets):
+        data = self.cache.get(modelId)
+        if data is not None:
+            data = dict(data)
+            data.update(deepcopy(sets))
+            for key in unsets or ():
+                data.pop(key, None)
+            self.cache.set(modelId, data)
+
+
+    def delete(self, model):
+        self.cache.delete(model.id)
+        result = super(CachedMongoBackend, self).delete(model)
+        # a load that read the document before it was removed may have
+        # cached it since the first delete
+        self._written()
+        self.cache.delete(model.id)
+        return result
@@ -0,0 +1,502 @@
+__all__ = ['SQLiteBackend']
+
+import datetime
+import json
+import os
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from ..utils import queryutils
+from ..utils import timeutils
+
+from base import BaseBackend
+
+
+## ENCODING -------------------------------------------------------------------
+#
+# Documents are stored as json. Datetimes are stored like mongo's extended
+# json, as {"$date": <milliseconds since the epoch>}, and come back as naive
+# UTC datetimes truncated to milliseconds.
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _default(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo:
+            value = value.astimezone(timeutils.utc_timezone)\
+                         .replace(tzinfo=None)
+        return {'$date': timeutils.format_timestamp(value,
+                                                    timeutils.TIMESTAMP_EPOCH)}
+    raise TypeError("%r can't be stored as json" % (value,))
+
+
+def _object_hook(obj):
+    if len(obj) == 1 and '$date' in obj:
+        return _EPOCH + datetime.timedelta(milliseconds=obj['$date'])
+    return obj
+
+
+def _encode(data):
+    return json.dumps(data, default=_default, separators=(',', ':'))
+
+
+def _decode(text):
+    return json.loads(text, object_hook=_object_hook)
+
+
+def _project(data, fields):
+    if fields is None:
+        return data
+    return dict((k, v) for k, v in data.iteritems() if k in fields)
+
+
+## QUERY TRANSLATION ----------------------------------------------------------
+#
+# find() queries are translated to a WHERE clause that selects every row that
+# could match, which is then checked with queryutils.match_query. Conditions
+# that can't be expressed (regexes, negations, datetimes...) are left out of
+# the clause. Since mongo conditions also match the elements of arrays, rows
+# where a queried path goes through an array are always selected.
+
+_MIN_INT = -2**63
+_MAX_INT = 2**63 - 1
+
+_COMPARISONS = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+
+def _split_path(field):
+    '''
+    Returns the parts of a dotted field, or None if it can't be expressed
+    as a json path (array indexes, or quotes in a key).
+    '''
+    parts = field.split('.')
+    for part in parts:
+        if not part or part.isdigit() or '"' in part:
+            return None
+    return parts
+
+
+def _json_path(parts):
+    # inlined as a literal rather than bound, so that queries use the
+    # expression indexes, which must match exactly
+    path = '$' + ''.join('."%s"' % part for part in parts)
+    return "'%s'" % path.replace("'", "''")
+
+
+def _sql_value(value):
+    '''
+    Returns value as a sqlite parameter, or None if it has no equivalent.
+    '''
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, long)):
+        return value if _MIN_INT <= value <= _MAX_INT else None
+    if isinstance(value, float):
+        return value if value == value else None
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    return None
+
+
+## BACKEND --------------------------------------------------------------------
+
+class SQLiteBackend(BaseBackend):
+    '''
+    Implements a collection in a sqlite database file, for a single host
+    without a mongo server. Each collection is a table of json documents.
+
+    Things().setBackend(SQLiteBackend, path='/var/lib/app/data.db',
+                        indexes=['name', 'address.city'])
+
+    find() understands the same queries as InMemoryBackend. Equality, $in,
+    range and $exists conditions are evaluated by sqlite, using an
+    expression index when the field has one, and everything else is checked
+    in python on the rows sqlite returns.
+
+    Databases are opened in WAL mode, so readers in any process don't block
+    the writer. Each thread (and process, after a fork) has its own
+    connection, with a cache of cachedStatements prepared statements. A
+    path of ':memory:' keeps the database in a single connection instead,
+    which isn't safe for use from several threads at once.
+    '''
+
+    def __init__(self, colName, path=':memory:', indexes=None,
+                 idGenerator=None, cachedStatements=256, timeout=5.0):
+        super(SQLiteBackend, self).__init__(colName, idGenerator)
+        self.path = path
+        self.cachedStatements = cachedStatements
+        self.timeout = timeout
+        self.table = '"%s"' % colName.replace('"', '""')
+        self._local = threading.local()
+        self._memory = None
+        self.indexes = []
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS %s (id PRIMARY KEY, '
+                         'data TEXT NOT NULL, multi INTEGER NOT NULL '
+                         'DEFAULT 0)' % self.table)
+            conn.execute('CREATE INDEX IF NOT EXISTS "%s:multi" ON %s '
+                         '(multi) WHERE multi = 1' % (self._indexPrefix(),
+                                                      self.table))
+            conn.execute('CREATE TABLE IF NOT EXISTS quickdata_indexes '
+                         '(collection TEXT, field TEXT, '
+                         'PRIMARY KEY (collection, field))')
+            cursor = conn.execute('SELECT field FROM quickdata_indexes '
+                                  'WHERE collection = ?', (colName,))
+            self.indexes = [field for field, in cursor]
+        for field in indexes or ():
+            self.addIndex(field)
+
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=None,
+                               check_same_thread=self.path != ':memory:',
+                               cached_statements=self.cachedStatements)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, or carried
+        # across a fork
+        if self.path == ':memory:':
+            if self._memory is None:
+                self._memory = self._connect()
+            return self._memory
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, 'pid', None) != pid:
+            local.conn = self._connect()
+            local.pid = pid
+        return local.conn
+
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+    def _indexPrefix(self):
+        return self.colName.replace('"', '""')
+
+
+    def addIndex(self, field):
+        '''
+        Declares an expression index on a (possibly dotted) field. Indexes
+        are recorded in the database, so every process using it sees them.
+        '''
+        parts = _split_path(field)
+        if parts is None:
+            raise ValueError("can't index field %s" % field)
+        if field in self.indexes:
+            return
+        with self._transaction() as conn:
+            conn.execute('CREATE INDEX IF NOT EXISTS "%s:%s" ON %s '
+                         '(json_extract(data, %s))' % (
+                             self._indexPrefix(), field.replace('"', '""'),
+                             self.table, _json_path(parts)))
+            conn.execute('INSERT OR IGNORE INTO quickdata_indexes '
+                         '(collection, field) VALUES (?, ?)',
+                         (self.colName, field))
+            self.indexes.append(field)
+            rows = conn.execute('SELECT id, data, multi FROM %s' %
+                                self.table).fetchall()
+            for modelId, text, multi in rows:
+                newMulti = self._multi(_decode(text))
+                if newMulti != multi:
+                    conn.execute('UPDATE %s SET multi = ? WHERE id = ?' %
+                                 self.table, (newMulti, modelId))
+
+
+    def _multi(self, data):
+        '''
+        Returns 1 if the path to any indexed field in data goes through an
+        array, so the row must be checked in python whatever the index says.
+        '''
+        for field in self.indexes:
+            value = data
+            for part in field.split('.'):
+                if not isinstance(value, dict):
+                    break
+                value = value.get(part)
+                if isinstance(value, list):
+                    return 1
+        return 0
+
+
+    def _row(self, model):
+        data = dict(model)
+        return (data['id'], _encode(data), self._multi(data))
+
+
+    # Query translation -----------------------
+
+    def _fieldClause(self, field, cond):
+        '''
+        Returns (sql, params) for a condition on field, selecting at least
+        every row that matches it, or None if it can't be narrowed down.
+        '''
+        if field == 'id':
+            expr = 'id'
+        else:
+            parts = _split_path(field)
+            if parts is None:
+                return None
+            expr = 'json_extract(data, %s)' % _json_path(parts)
+
+        if not queryutils.is_operator_dict(cond):
+            cond = {'$eq': cond}
+        clauses = []
+        params = []
+        for op, arg in cond.iteritems():
+            if op == '$eq':
+                if arg is None:
+                    clauses.append('%s IS NULL' % expr)
+                    continue
+                value = _sql_value(arg)
+                if value is not None:
+                    clauses.append('%s = ?' % expr)
+                    params.append(value)
+            elif op in _COMPARISONS:
+                value = _sql_value(arg)
+                if value is not None and not isinstance(arg, bool):
+                    clauses.append('%s %s ?' % (expr, _COMPARISONS[op]))
+                    params.append(value)
+            elif op == '$in' and isinstance(arg, (list, tuple)) and arg:
+                values = map(_sql_value, arg)
+                if None not in values:
+                    clauses.append('%s IN (%s)' % (expr,
+                                                   ','.join('?' * len(values))))
+                    params.extend(values)
+            elif op == '$exists' and arg and field != 'id':
+                clauses.append('json_type(data, %s) IS NOT NULL' %
+                               _json_path(parts))
+        if not clauses:
+            return None
+        sql = ' AND '.join(clauses)
+        if field == 'id':
+            return sql, params
+
+        if field in self.indexes:
+            escape = 'multi = 1'
+        else:
+            escape = ' OR '.join("json_type(data, %s) = 'array'" %
+                                 _json_path(parts[:i + 1])
+                                 for i in range(len(parts)))
+        return '(%s OR %s)' % (sql, escape), params
+
+
+    def _where(self, query):
+        '''
+        Returns (sql, params) selecting at least the rows matching query,
+        with an empty sql if every row has to be checked.
+        '''
+        clauses = []
+        params = []
+        for key, cond in query.iteritems():
+            if key == '$and':
+                found = [self._where(subquery) for subquery in cond]
+            elif key == '$or':
+                found = [self._where(subquery) for subquery in cond]
+                if not found or not all(sql for sql, p in found):
+                    continue
+                found = [('(%s)' % ' OR '.join('(%s)' % sql
+                                               for sql, p in found),
+                          sum((p for sql, p in found), []))]
+            elif key.startswith('$'):
+                continue
+            else:
+                found = [self._fieldClause(key, cond)]
+            for clause in found:
+                if clause and clause[0]:
+                    clauses.append(clause[0])
+                    params.extend(clause[1])
+        return ' AND '.join(clauses), params
+
+
+    def _select(self, columns, query, after=None, limit=None):
+        sql, params = self._where(query)
+        clauses = [sql] if sql else []
+        if after is not None:
+            clauses.append('id > ?')
+            params.append(after)
+        statement = 'SELECT %s FROM %s' % (columns, self.table)
+        if clauses:
+            statement += ' WHERE ' + ' AND '.join(clauses)
+        if limit is not None:
+            statement += ' ORDER BY id LIMIT %d' % limit
+        return self._connection().execute(statement, params)
+
+
+    # Backend functions -----------------------
+
+    def add(self, model):
+        '''
+        Adds a model to this collection. Relies on the super class' save
+        functionality to assign an id.
+        '''
+        return model.save()
+
+
+    def saveModel(self, model):
+        row = self._row(model)
+        self._connection().execute('INSERT OR REPLACE INTO %s '
+                                   '(id, data, multi) VALUES (?, ?, ?)' %
+                                   self.table, row)
+        return row[0]
+
+
+    def saveMany(self, models, batchSize=1000, ordered=True):
+        '''
+        Saves (upserts) many models, writing up to batchSize models per
+        transaction. Returns the list of saved ids.
+        '''
+        statement = 'INSERT OR REPLACE INTO %s (id, data, multi) ' \
+                    'VALUES (?, ?, ?)' % self.table
+        rows = [self._row(model) for model in models]
+        batchSize = batchSize or len(rows) or 1
+        for start in range(0, len(rows), batchSize):
+            with self._transaction() as conn:
+                conn.executemany(statement, rows[start:start + batchSize])
+        return [row[0] for row in rows]
+
+
+    def getItem(self, modelId):
+        row = self._connection().execute('SELECT data FROM %s WHERE id = ?' %
+                                         self.table, (modelId,)).fetchone()
+        return _decode(row[0]) if row else None
+
+
+    def _byIds(self, columns, modelIds):
+        # in chunks, to stay under sqlite's limit on parameters
+        modelIds = list(modelIds)
+        conn = self._connection()
+        for start in range(0, len(modelIds), 500):
+            chunk = modelIds[start:start + 500]
+            cursor = conn.execute('SELECT %s FROM %s WHERE id IN (%s)' % (
+                                  columns, self.table, ','.join('?' *
+                                                                len(chunk))),
+                                  chunk)
+            for row in cursor:
+                yield row
+
+
+    def getItems(self, modelIds, fields=None):
+        result = {}
+        for modelId, text in self._byIds('id, data', modelIds):
+            result[modelId] = _project(_decode(text), fields)
+        return result
+
+
+    def exists(self, modelIds):
+        return set(modelId for modelId, in self._byIds('id', modelIds))
+
+
+    def updateModel(self, modelId, sets, unsets=None):
+        '''
+        Updates only the given fields of a stored document.
+        '''
+        with self._transaction() as conn:
+            self._updateRow(conn, modelId, sets, unsets)
+
+
+    def updateMany(self, updates, batchSize=1000, ordered=True):
+        '''
+        Applies many (modelId, sets, unsets) updates, up to batchSize per
+        transaction.
+        '''
+        updates = list(updates)
+        batchSize = batchSize or len(updates) or 1
+        for start in range(0, len(updates), batchSize):
+            with self._transaction() as conn:
+                for modelId, sets, unsets in updates[start:start + batchSize]:
+                    self._updateRow(conn, modelId, sets, unsets)
+
+
+    def _updateRow(self, conn, modelId, sets, unsets):
+        row = conn.execute('SELECT data FROM %s WHERE id = ?' %
+                           self.table, (modelId,)).fetchone()
+        if row is None:
+            return
+        data = _decode(row[0])
+        data.update((k, v) for k, v in sets.iteritems() if k != 'id')
+        for key in unsets or ():
+            data.pop(key, None)
+        conn.execute('UPDATE %s SET data = ?, multi = ? WHERE id = ?' %
+                     self.table, (_encode(data), self._multi(data), modelId))
+
+
+    def delete(self, model):
+        self._connection().execute('DELETE FROM %s WHERE id = ?' %
+                                   self.table, (model.id,))
+
+
+    def len(self):
+        return self._connection().execute('SELECT COUNT(*) FROM %s' %
+                                          self.table).fetchone()[0]
+
+
+    def iter(self, fields=None):
+        return self.find({}, fields=fields)
+
+
+    def find(self, query, limit=None, fields=None):
+        '''
+        Yields the documents matching query. The query's rows are all read
+        before the first document is yielded, so models saved while
+        iterating can't move ahead of an open cursor and be read again.
+        '''
+        cursor = self._select('data', query)
+        if limit:
+            found = []
+            for text, in cursor:
+                data = _decode(text)
+                if queryutils.match_query(query, data):
+                    found.append(_project(data, fields))
+                    if len(found) >= limit:
+                        break
+            cursor.close()
+            for data in found:
+                yield data
+            return
+        # kept as json until yielded, which takes less memory
+        for text, in cursor.fetchall():
+            data = _decode(text)
+            if queryutils.match_query(query, data):
+                yield _project(data, fields)
+
+
+    def scan(self, query, batchSize=1000, startAfter=None, fields=None):
+        '''
+        Yields the documents matching query in lists of up to batchSize, in
+        id order. Each batch is a separate query for the ids after the last
+        one seen, so no read transaction is held open between batches.
+        '''
+        while True:
+            rows = self._select('id, data', query, after=startAfter,
+                                limit=batchSize).fetchall()
+            batch = []
+            for modelId, text in rows:
+                data = _decode(text)
+                if queryutils.match_query(query, data):
+                    batch.append(_project(data, fields))
+            if batch:
+                yield batch
+            if len(rows) < batchSize:
+                return
+            startAfter = rows[-1][0]
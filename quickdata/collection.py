@@ -1,8 +1,21 @@
 __all__ = ['Collection', 'CollectionError', 'CollectionUnexpectedError']
 
+import functools
+import itertools
+from copy import deepcopy
+from time import time
+
 from utils import errorutils
+from utils import columnutils
+from utils import metricutils
+from utils import timeutils
+from utils.cacheutils import LRUCache
+from utils.metricutils import instrumented
+from utils.queryutils import normalize_query
 from model import Model
+from record import Record, makeRecordClass
 from backends.base import BaseBackend
+from writebehind import WriteBehindBuffer
 
 
 class CollectionError(errorutils.UnexpectedError):
@@ -12,6 +25,21 @@ class CollectionUnexpectedError(errorutils.UnexpectedError):
     pass
     
 
+def writes(fn):
+    '''
+    Decorates a Collection backend call that changes stored documents, so
+    that it invalidates the collection's cached query results.
+    '''
+    @functools.wraps(fn)
+    def wrapped(self, *args, **kwargs):
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            if self.queryCache is not None:
+                self._writeVersion = next(self._writeCounter)
+    return wrapped
+
+
 class Singleton(type):
     def __init__(cls, name, bases, dict):
         super(Singleton, cls).__init__(name, bases, dict)
@@ -34,13 +62,107 @@ class Collection(object):
     classField = 'class'
     backend = None
 
+    # how created and modified are stored, one of timeutils.TIMESTAMP_ISO,
+    # TIMESTAMP_DATETIME or TIMESTAMP_EPOCH
+    timestampFormat = timeutils.TIMESTAMP_ISO
+
+    # find() result cache, see setQueryCache
+    queryCache = None
+    queryCacheMaxResults = None
+    _writeVersion = 0
+
+    # buffers saves when set, see setWriteBehind
+    writeBuffer = None
+
+    # generated Record classes, by (model class, partial)
+    _recordClasses = None
+
 
     def setBackend(self, backend=None, **kwargs):
         kwargs.update(colName=self.__class__.__name__)
         backend = BaseBackend() if backend == None else backend(**kwargs)
+        if self.writeBuffer is not None:
+            self.writeBuffer.flush()
+            self.writeBuffer.backend = backend
         self.backend = backend
 
 
+    def setQueryCache(self, maxEntries=1000, maxBytes=None, expiry=None,
+                      maxResults=1000):
+        '''
+        Caches the results of find() in process, keyed on the query, limit
+        and fields. Every save or delete through this collection
+        invalidates the cached results, so they are never older than the
+        last write made here. Writes made by other processes aren't seen:
+        set expiry (in seconds) to bound how stale results may get.
+
+        At most maxEntries result sets, taking roughly maxBytes, are kept,
+        and queries matching more than maxResults documents aren't cached.
+        Pass maxEntries=None to turn the cache off.
+        '''
+        if maxEntries is None:
+            self.queryCache = None
+            return
+        self.queryCache = LRUCache(max_entries=maxEntries, max_bytes=maxBytes,
+                                   expiry_time=expiry)
+        self.queryCacheMaxResults = maxResults
+        self._writeCounter = itertools.count(self._writeVersion + 1)
+
+
+    def setWriteBehind(self, maxPending=1000, flushInterval=1.0):
+        '''
+        Buffers saves instead of writing each one as it happens. Saves of
+        the same model are merged, and a background thread writes them in
+        bulk once maxPending models are waiting or every flushInterval
+        seconds. Reads by id see the buffered saves; find, iter, scan and
+        len flush the buffer first. Deletes are written straight away.
+
+        Pending saves are written when the process exits, or by flush().
+        Pass maxPending=None to flush and stop buffering.
+        '''
+        self._check_backend()
+        if self.writeBuffer is not None:
+            self.writeBuffer.close()
+            self.writeBuffer = None
+        if maxPending is not None:
+            self.writeBuffer = WriteBehindBuffer(self.backend, maxPending,
+                                                 flushInterval,
+                                                 self.__class__.__name__)
+
+
+    def flush(self):
+        '''
+        Writes any saves held by the write behind buffer. Returns the
+        number of models written.
+        '''
+        if self.writeBuffer is None:
+            return 0
+        return self.writeBuffer.flush()
+
+
+    def writeBehindStats(self):
+        '''
+        Returns the write behind buffer's queue depth and flush stats (see
+        WriteBehindBuffer.stats), or None if saves aren't buffered.
+        '''
+        if self.writeBuffer is None:
+            return None
+        return self.writeBuffer.stats()
+
+
+    def queryCacheStats(self):
+        '''
+        Returns the query cache's entries, bytes, hits, misses, evictions
+        and hitRate, or None if there is no query cache.
+        '''
+        if self.queryCache is None:
+            return None
+        stats = self.queryCache.stats()
+        lookups = stats['hits'] + stats['misses']
+        stats['hitRate'] = float(stats['hits']) / lookups if lookups else None
+        return stats
+
+
     def toModel(self, modelOrId):
         '''
         If passed an id, converts to the model for that id. If passed a model
@@ -48,6 +170,8 @@ class Collection(object):
         '''
         if isinstance(modelOrId, Model):
             return modelOrId
+        elif isinstance(modelOrId, Record):
+            return modelOrId.toModel()
         else:
             return self[modelOrId]
 
@@ -57,26 +181,50 @@ class Collection(object):
         If passed a model, returns its id otherwise returns the id.
         Primarily used internally.
         '''
-        if isinstance(modelOrId, Model):
+        if isinstance(modelOrId, (Model, Record)):
             return modelOrId['id']
         else:
             return modelOrId
 
 
+    def _uniqueIds(self):
+        '''
+        True if the backend's id generator never produces colliding ids, so
+        new ids don't need to be checked against the database.
+        '''
+        generator = getattr(self.backend, 'idGenerator', None)
+        return getattr(generator, 'unique', False)
+
+
     def makeId(self, model):
         '''
         Generates a new unique id for this collection.
         '''
         while True:
             newid = self._do_makeId(model)
-            try:
-                exists = self[newid]
-            except KeyError:
-                return newid
-            if not exists:
+            if self._uniqueIds() or not self._do_exists([newid]):
                 return newid
 
 
+    def makeIds(self, models):
+        '''
+        Generates new unique ids for many models at once.
+        '''
+        if not models:
+            return []
+        ids = self._do_makeIds(models)
+        if self._uniqueIds():
+            return ids
+        taken = self._do_exists(ids)
+        result = []
+        for model, newid in zip(models, ids):
+            if newid in taken:
+                newid = self.makeId(model)
+            taken.add(newid)
+            result.append(newid)
+        return result
+
+
     def createClass(self, cls, *args, **kwargs):
         '''
         Creates a new Model of the given class and adds it
@@ -120,6 +268,25 @@ class Collection(object):
             return default
 
 
+    def getMany(self, modelIds, default=None, fields=None):
+        '''
+        Gets many models stored in this collection, fetching them from the
+        backend together. Returns a list in the same order as modelIds, with
+        default in place of any id that wasn't found. If fields is given the
+        models are only partially loaded (see find).
+        '''
+        modelIds = list(modelIds)
+        fields = self._projection(fields)
+        params = {'fields':fields} if fields else {}
+        found = self._do_getItems(modelIds, **params)
+        result = []
+        for modelId in modelIds:
+            data = found.get(modelId)
+            result.append(self._modelFromData(data, fields) if data \
+                          else default)
+        return result
+
+
     def add(self, model):
         '''
         Adds a model to this collection. Note: this leaves it up to the 
@@ -138,22 +305,118 @@ class Collection(object):
         return self._do_add(model)
 
 
+    def saveMany(self, models, full=False, **kwargs):
+        '''
+        Saves many models at once, letting the backend batch the writes.
+        Models are attached to this collection and prepared exactly as
+        Model.save() would, with the ids of new models allocated as a
+        block. New models, and all of them if full is set, are written
+        whole in one batch. Like Model.save(), models loaded from the
+        database only update the keys that changed, and partial models only
+        the fields they have, and unchanged ones aren't written at all.
+        Extra keyword arguments (such as batchSize or ordered) are passed to
+        the backend. Returns the list of ids.
+        '''
+        models = list(models)
+        for model in models:
+            model._collection = self
+        changed = [model for model in models if model._needsSave(full)]
+        newModels = [model for model in changed if not 'id' in model]
+        newIds = dict(zip(map(id, newModels), self.makeIds(newModels)))
+        whole = []
+        updates = []
+        for model in changed:
+            if full and model._partial:
+                model._loadMissing()
+            model._savePrep(newIds.get(id(model)))
+            update = model._saveUpdate(full)
+            if update is None:
+                whole.append(model)
+            else:
+                updates.append((model['id'],) + update)
+        if whole:
+            self._do_saveMany(whole, **kwargs)
+        if updates:
+            self._do_updateMany(updates, **kwargs)
+        for model in changed:
+            model._markClean()
+        return [model['id'] for model in models]
+
+
+    def exists(self, modelIdsOrModels):
+        '''
+        Returns the set of the given ids (or models' ids) that are stored in
+        this collection, without loading the models.
+        '''
+        return self._do_exists(map(self.toId, modelIdsOrModels))
+
+
     def __contains__(self, modelOrId):
         modelId = self.toId(modelOrId)
-        try:
-            return self[modelId]
-        except KeyError:
-            return False
+        return modelId in self._do_exists([modelId])
+
+
+    def _projection(self, fields):
+        '''
+        Converts a list of fields to load into the list of top level fields
+        to request from the backend, always including the id and class.
+        '''
+        if fields is None:
+            return None
+        fields = set(field.split('.')[0] for field in fields)
+        fields.update(['id', self.classField])
+        return list(fields)
 
 
-    def _modelFromData(self, data):
+    @instrumented('hydrate', count='one')
+    def _modelFromData(self, data, fields=None):
         modelclass = self.getClass(data)
         model = modelclass.__new__(modelclass)
         model.unpack(**data)
         model._collection = self
+        if fields is not None:
+            model._partial = True
         return model
 
 
+    def toDataMany(self, models, include_computed=False):
+        '''
+        Returns the list of models' toData() dicts, looking up each model
+        class's serializer once rather than once per model.
+        '''
+        return list(self.iterToData(models, include_computed))
+
+
+    def iterToData(self, models, include_computed=False):
+        '''
+        Like toDataMany, but yields the dicts one at a time, so any iterator
+        of models (such as find or scan) can be serialized as it streams.
+        '''
+        classField = self.classField
+        serializers = {}
+        for model in models:
+            cls = model.__class__
+            try:
+                serialize = serializers[cls]
+            except KeyError:
+                serialize = serializers[cls] = \
+                    cls._serializer(include_computed, classField)
+            yield serialize(model)
+
+
+    @instrumented('hydrate', count='one')
+    def _recordFromData(self, data, fields=None):
+        key = (self.getClass(data), fields is not None)
+        try:
+            recordclass = self._recordClasses[key]
+        except (KeyError, TypeError):
+            if self._recordClasses is None:
+                self._recordClasses = {}
+            recordclass = self._recordClasses[key] = \
+                makeRecordClass(key[0], self, key[1])
+        return recordclass._fromData(data)
+
+
     def __getitem__(self, modelId):
         '''
         obviously this is quite inefficient. Later I should implement a simple
@@ -166,16 +429,125 @@ class Collection(object):
 
 
     def __iter__(self):
-        for data in self._do_iter():
-            yield self._modelFromData(data)
+        return self.iter()
 
 
-    def find(self, query, limit=None, **kwargs):
+    def iter(self, fields=None):
+        '''
+        Iterates over every model in the collection. If fields is given the
+        models are only partially loaded (see find).
+        '''
+        fields = self._projection(fields)
+        params = {'fields':fields} if fields else {}
+        for data in self._do_iter(**params):
+            yield self._modelFromData(data, fields)
+
+
+    def find(self, query, limit=None, fields=None, records=False, **kwargs):
+        '''
+        Iterates over the models matching query. If fields is given, only
+        those fields (plus the id and class) are fetched. The resulting
+        models are partial: reading a field that wasn't loaded fetches the
+        rest of the document, and saving only updates the loaded fields.
+
+        If records is set yields compact read-only Records instead of
+        models (see record.Record), for reading large result sets.
+        '''
+        fields = self._projection(fields)
         params = {'limit':limit} if limit else {}
+        if fields:
+            params['fields'] = fields
         params.update(**kwargs)
 
+        if self.queryCache is not None:
+            results = self._cachedFind(query, params)
+        else:
+            results = self._do_find(query, **params)
+        hydrate = self._recordFromData if records else self._modelFromData
+        for data in results:
+            yield hydrate(data, fields)
+
+
+    def findColumns(self, query, fields, dtypes=None, limit=None,
+                    batchSize=1000):
+        '''
+        Reads fields of the documents matching query straight into numpy
+        arrays, without making models. Returns a dict mapping each field
+        (dotted paths are allowed) to a numpy masked array, with missing and
+        null values masked. Requires numpy.
+
+        Booleans, integers, floats and datetimes get typed columns, other
+        values are stored as objects. dtypes can map fields to the numpy
+        dtype to use instead, for example 'datetime64[ms]' for created and
+        modified, which converts iso strings and epoch milliseconds.
+        '''
+        params = {'fields': self._projection(fields)}
+        if limit:
+            params['limit'] = limit
+        return columnutils.build_columns(self._do_find(query, **params),
+                                         fields, dtypes, batchSize)
+
+
+    def _cachedFind(self, query, params):
+        '''
+        Returns the documents matching query from the query cache, or
+        iterates over them from the backend, caching them once exhausted.
+        The cache keeps its own copies of the documents.
+        The key includes the write version, so results cached before the
+        last write are never returned and simply age out of the cache.
+        '''
+        try:
+            key = (self._writeVersion, normalize_query(query),
+                   normalize_query(params))
+        except TypeError:
+            return self._do_find(query, **params)
+        start = time()
+        results = self.queryCache.get(key)
+        if metricutils.sinks:
+            metricutils.emit('queryCache', self.__class__.__name__,
+                             time() - start,
+                             cache='miss' if results is None else 'hit')
+        if results is not None:
+            # copies, so changing a model in place doesn't change the cache
+            return (deepcopy(data) for data in results)
+        return self._findAndCache(key, query, params)
+
+
+    def _findAndCache(self, key, query, params):
+        results = []
         for data in self._do_find(query, **params):
-            yield self._modelFromData(data)
+            if results is not None:
+                results.append(deepcopy(data))
+                maxResults = self.queryCacheMaxResults
+                if maxResults is not None and len(results) > maxResults:
+                    results = None
+            yield data
+        if results is not None:
+            self.queryCache.set(key, results)
+
+
+    def scan(self, query=None, batchSize=1000, startAfter=None, fields=None,
+             chunked=False, records=False):
+        '''
+        Iterates over the models matching query (or all models) in id order,
+        fetching batchSize models at a time so memory use stays constant
+        however large the collection is. To resume an interrupted scan pass
+        the id of the last model processed as startAfter. If chunked is set
+        yields lists of models, one per batch, instead of single models. If
+        records is set yields read-only Records instead of models (see
+        find).
+        '''
+        fields = self._projection(fields)
+        batches = self._do_scan(query or {}, batchSize=batchSize,
+                                startAfter=startAfter, fields=fields)
+        hydrate = self._recordFromData if records else self._modelFromData
+        for batch in batches:
+            models = [hydrate(data, fields) for data in batch]
+            if chunked:
+                yield models
+            else:
+                for model in models:
+                    yield model
 
 
     def __delitem__(self, modelOrId):
@@ -185,42 +557,112 @@ class Collection(object):
 
 
     # Backend functions to implement -----------------------
+    #
+    # Each call emits a metrics event when metricutils sinks are registered.
 
     def _check_backend(self):
         if not hasattr(self, 'backend') or self.backend == None:
             raise CollectionError("backend not configured")
 
 
+    @instrumented('makeId')
     def _do_makeId(self, model):
         self._check_backend()
-        return self.backend.make_Id(model)
+        return self.backend.makeId(model)
+
+    @instrumented('makeIds', count='arg')
+    def _do_makeIds(self, models):
+        self._check_backend()
+        return self.backend.makeIds(models)
 
+    @writes
+    @instrumented('add')
     def _do_add(self, model):
         self._check_backend()
         return self.backend.add(model)
 
+    @writes
+    @instrumented('saveModel', count='one')
     def _do_saveModel(self, model):
         self._check_backend()
+        if self.writeBuffer is not None:
+            return self.writeBuffer.save(model)
         return self.backend.saveModel(model)
 
+    @writes
+    @instrumented('saveMany', count='arg')
+    def _do_saveMany(self, models, **kwargs):
+        self._check_backend()
+        if self.writeBuffer is not None:
+            return self.writeBuffer.saveMany(models)
+        return self.backend.saveMany(models, **kwargs)
+
+    @writes
+    @instrumented('delete')
     def _do_delete(self, model):
         self._check_backend()
+        if self.writeBuffer is not None:
+            return self.writeBuffer.delete(model)
         return self.backend.delete(model)
 
+    @instrumented('getItem', count='one')
     def _do_getItem(self, modelId):
         self._check_backend()
+        if self.writeBuffer is not None:
+            return self.writeBuffer.getItem(modelId)
         return self.backend.getItem(modelId)
 
-    def _do_iter(self):
+    @instrumented('getItems', count='result')
+    def _do_getItems(self, modelIds, **kwargs):
+        self._check_backend()
+        if self.writeBuffer is not None:
+            return self.writeBuffer.getItems(modelIds, **kwargs)
+        return self.backend.getItems(modelIds, **kwargs)
+
+    @instrumented('exists', count='arg')
+    def _do_exists(self, modelIds):
+        self._check_backend()
+        if self.writeBuffer is not None:
+            return self.writeBuffer.exists(modelIds)
+        return self.backend.exists(modelIds)
+
+    @writes
+    @instrumented('updateModel')
+    def _do_updateModel(self, modelId, sets, unsets=None):
+        self._check_backend()
+        if self.writeBuffer is not None:
+            return self.writeBuffer.update(modelId, sets, unsets)
+        return self.backend.updateModel(modelId, sets, unsets)
+
+    @writes
+    @instrumented('updateMany', count='arg')
+    def _do_updateMany(self, updates, **kwargs):
+        self._check_backend()
+        if self.writeBuffer is not None:
+            return self.writeBuffer.updateMany(updates)
+        return self.backend.updateMany(updates, **kwargs)
+
+    @instrumented('iter', stream=True)
+    def _do_iter(self, **kwargs):
+        self._check_backend()
+        self.flush()
+        return self.backend.iter(**kwargs)
+
+    @instrumented('find', stream=True)
+    def _do_find(self, query, **kwargs):
         self._check_backend()
-        return self.backend.iter()
+        self.flush()
+        return self.backend.find(query, **kwargs)
 
-    def _do_find(self, query):
+    @instrumented('scan', stream=True, batches=True)
+    def _do_scan(self, query, **kwargs):
         self._check_backend()
-        return self.backend.find(query)
+        self.flush()
+        return self.backend.scan(query, **kwargs)
 
     def __len__(self):
         self._check_backend()
+        self.flush()
         return self.backend.len()
 
 
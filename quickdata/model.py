@@ -1,6 +1,7 @@
 __all__ = ['Model', 'ModelUnexpectedError']
 
 from copy import copy
+import datetime
 import inspect
 
 from utils import errorutils
@@ -14,6 +15,25 @@ class ModelUnexpectedError(errorutils.UnexpectedError):
 
 ## MODEL CLASSES --------------------------------------------------------------
 
+class ModelMeta(type):
+    '''
+    Computes the field tables of each model class once, when the class is
+    created, so that attribute and item access are simple set lookups.
+    '''
+    def __init__(cls, name, bases, dict):
+        super(ModelMeta, cls).__init__(name, bases, dict)
+        cls._fields = cls._accum_attr('fields')
+        cls._computed_fields = cls._accum_attr('computed_fields')
+        cls._computedFieldSet = frozenset(cls._computed_fields)
+        cls._fieldSet = frozenset(cls._fields) | cls._computedFieldSet
+        # memoized computed fields, and the ones each key invalidates
+        cls._computed_dependencies = cls._accum_attr('computed_dependencies')
+        cls._memoizedFieldSet = frozenset(cls._computed_dependencies)
+        cls._dependents = cls._dependentFields()
+        # toData serializers, built on first use, see Model._serializer
+        cls._serializers = {}
+
+
 class Model(dict):
     '''
     Abstract base model class. The Model is a subclass of dict, where any
@@ -49,10 +69,39 @@ class Model(dict):
     parameters. In that case it should override unpack() to call self.__init__, 
     filling in those parameters. Unpack is only called when creating models 
     from data fetched from the database.
+
+    Computed fields are called each time they're read, unless they're listed
+    in computed_dependencies with the keys they're computed from. Their value
+    is then kept on the model until one of those keys is set or deleted:
+
+    computed_fields = {'score': lambda self: rank(self.votes, self.views)}
+    computed_dependencies = {'score': ['votes', 'views']}
+
+    Models loaded from the database keep track of the keys changed since
+    they were loaded, and save() only sends those. Changing a value in
+    place (like appending to a list) isn't noticed: call markDirty(key)
+    afterwards, or save(full=True) to write the whole document.
     '''
 
+    __metaclass__ = ModelMeta
+
     fields = ['id', 'created', 'modified', 'class']
     computed_fields = {}
+    computed_dependencies = {}
+
+    # the collection the model was loaded from or saved to
+    _collection = None
+
+    # set on models loaded with only some of their fields
+    _partial = False
+
+    # values of the memoized computed fields, see computed_dependencies
+    _computedCache = None
+
+    # keys set and deleted since the model was loaded or saved. None when
+    # changes aren't tracked, in which case the whole model is saved.
+    _dirty = None
+    _removed = None
 
 
     @classmethod
@@ -70,6 +119,33 @@ class Model(dict):
         return list(values) if type(values) == set else values
 
 
+    @classmethod
+    def _dependentFields(cls):
+        '''
+        Maps each key to the memoized computed fields depending on it, also
+        through other computed fields.
+        '''
+        deps = cls._computed_dependencies
+        unknown = set(deps) - cls._computedFieldSet
+        if unknown:
+            raise ModelUnexpectedError("computed_dependencies of %s aren't "
+                                       "computed fields: %s" %
+                                       (cls.__name__, ', '.join(unknown)))
+
+        def expand(name, seen):
+            for key in deps.get(name, ()):
+                if key not in seen:
+                    seen.add(key)
+                    expand(key, seen)
+            return seen
+
+        dependents = {}
+        for name in deps:
+            for key in expand(name, set()):
+                dependents.setdefault(key, set()).add(name)
+        return dict((key, tuple(names)) for key, names in dependents.iteritems())
+
+
     @classmethod
     def getFields(cls):
         return cls.getAllFields(include_computed=False)
@@ -77,26 +153,39 @@ class Model(dict):
 
     @classmethod
     def getAllFields(cls, include_computed=True):
-        if not hasattr(cls, '_fields'):
-            cls._fields = cls._accum_attr('fields')
         fields = copy(cls._fields)
         if include_computed:
-            fields += cls.getComputedFields().keys()
+            fields += cls._computed_fields.keys()
         return fields
 
 
     @classmethod
     def getComputedFields(cls):
-        try:
-            return cls._computed_fields
-        except AttributeError:
-            cls._computed_fields = cls._accum_attr('computed_fields')
-            return cls._computed_fields
+        return cls._computed_fields
 
 
     def computeField(self, attr):
-        fn = self.getComputedFields()[attr]
-        return fn(self)
+        fn = self._computed_fields[attr]
+        if attr not in self._memoizedFieldSet:
+            return fn(self)
+        cache = self._computedCache
+        if cache is None:
+            cache = self._computedCache = {}
+        try:
+            return cache[attr]
+        except KeyError:
+            value = cache[attr] = fn(self)
+            return value
+
+
+    def _invalidate(self, key):
+        '''
+        Drops the memoized computed fields depending on key.
+        '''
+        cache = self._computedCache
+        if cache:
+            for name in self._dependents.get(key, ()):
+                cache.pop(name, None)
 
 
     def __init__(self, **data):
@@ -113,6 +202,23 @@ class Model(dict):
             pass
 
         super(Model, self).__init__(**data)
+        self._computedCache = None
+
+
+    def __copy__(self):
+        '''
+        Returns a shallow copy with its own change tracking, so changing
+        either model doesn't mark keys on the other.
+        '''
+        model = self.__class__.__new__(self.__class__)
+        dict.update(model, self)
+        model.__dict__.update(self.__dict__)
+        if self._dirty is not None:
+            model._dirty = set(self._dirty)
+            model._removed = set(self._removed)
+        if self._computedCache:
+            model._computedCache = dict(self._computedCache)
+        return model
 
 
     def __unicode__(self):
@@ -132,13 +238,14 @@ class Model(dict):
         fetched from the database.
         '''
         self.__init__(**data)
+        self._markClean()
 
 
     def __getattr__(self, attr):
         ''' Maps dot notation to dict notation '''
-        if attr in self.getAllFields():
+        if attr in self._fieldSet:
             try:
-                if attr in self.getComputedFields():
+                if attr in self._computedFieldSet:
                     return self.computeField(attr)
                 else:
                     return self[attr]
@@ -150,8 +257,8 @@ class Model(dict):
 
     def __setattr__(self, attr, value):
         ''' Maps dot notation to dict notation '''
-        if attr in self.getAllFields():
-            if attr in self.getComputedFields():
+        if attr in self._fieldSet:
+            if attr in self._computedFieldSet:
                 raise AttributeError("Could not set computed attr %s" % attr)
             self[attr] = value
         else:
@@ -159,16 +266,92 @@ class Model(dict):
 
 
     def __getitem__(self, key):
-        if key in self.getComputedFields():
+        if key in self._computedFieldSet:
             return self.computeField(key)
-        else:
+        try:
             return super(Model, self).__getitem__(key)
+        except KeyError:
+            if not self._partial:
+                raise
+        self._loadMissing()
+        return super(Model, self).__getitem__(key)
 
 
     def __setitem__(self, key, value):
-        if key in self.getComputedFields():
+        if key in self._computedFieldSet:
             raise KeyError("Could not set value for computed key %s" % key)
         super(Model, self).__setitem__(key, value)
+        self._invalidate(key)
+        if self._dirty is not None:
+            self._dirty.add(key)
+            self._removed.discard(key)
+
+
+    def __delitem__(self, key):
+        super(Model, self).__delitem__(key)
+        self._invalidate(key)
+        if self._dirty is not None:
+            self._dirty.discard(key)
+            self._removed.add(key)
+
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+
+    def setdefault(self, key, default=None):
+        if not super(Model, self).__contains__(key):
+            self[key] = default
+        return self[key]
+
+
+    def pop(self, key, *default):
+        present = super(Model, self).__contains__(key)
+        value = super(Model, self).pop(key, *default)
+        self._invalidate(key)
+        if present and self._dirty is not None:
+            self._dirty.discard(key)
+            self._removed.add(key)
+        return value
+
+
+    def popitem(self):
+        # which key goes is arbitrary, fall back to saving everything
+        self._dirty = self._removed = None
+        self._computedCache = None
+        return super(Model, self).popitem()
+
+
+    def clear(self):
+        self._dirty = self._removed = None
+        self._computedCache = None
+        return super(Model, self).clear()
+
+
+    def markDirty(self, *keys):
+        '''
+        Records that the values of keys were changed in place, so that the
+        next save() writes them, and the computed fields depending on them
+        are computed again.
+        '''
+        for key in keys:
+            self._invalidate(key)
+        if self._dirty is not None:
+            self._dirty.update(keys)
+
+
+    def isDirty(self):
+        '''
+        Returns False if the model is known to be unchanged since it was
+        loaded or last saved.
+        '''
+        return self._dirty is None or bool(self._dirty or self._removed)
+
+
+    def _markClean(self):
+        self._dirty = set()
+        self._removed = set()
 
 
     def get(self, key, default=None):
@@ -178,25 +361,52 @@ class Model(dict):
             return default
 
 
+    @classmethod
+    def _serializer(cls, include_computed=False, classField=None):
+        '''
+        Returns a function converting a model of this class to the dict
+        returned by toData. Built once per class, include_computed and
+        classField, so serializing only walks the model's own items.
+        '''
+        key = (include_computed, classField)
+        try:
+            return cls._serializers[key]
+        except KeyError:
+            pass
+
+        stored = set(cls._fields)
+        stored.add('_id')
+        if classField is not None:
+            stored.add(classField)
+        stored = frozenset(stored - cls._computedFieldSet)
+        computed = tuple((k, _memoized(k) if k in cls._memoizedFieldSet
+                             else fn)
+                         for k, fn in cls._computed_fields.iteritems()) \
+                   if include_computed else ()
+        iteritems = dict.iteritems
+
+        def serialize(model):
+            data = {k: v for k, v in iteritems(model) if k in stored}
+            for k, fn in computed:
+                try:
+                    data[k] = fn(model)
+                except (KeyError, AttributeError):
+                    pass
+            return data
+
+        cls._serializers[key] = serialize
+        return serialize
+
+
     def toData(self, include_computed=False):
         ''' Returns a dictionary representation of the model's data.
 
         This representation will only include the model's fields and
         computed_fields.
         '''
-        fields = self.getAllFields(include_computed=include_computed) + ['_id']
-        if self._collection:
-            fields += [self._collection.classField]
-        cfields = self.getComputedFields().keys() if include_computed else []
-        existing_fields = self.keys() + cfields
-
-        class NoComputedValue(object): 
-            pass
-
-        getval = lambda k: self.get(k, NoComputedValue())
-        result = list((k, getval(k)) for k in fields if k in existing_fields)
-        result = dict(filter(lambda t: type(t[1]) != NoComputedValue, result))
-        return result
+        collection = self._collection
+        classField = collection.classField if collection is not None else None
+        return self._serializer(include_computed, classField)(self)
 
     # def iterkeys(self):
     #     for k in super(Model, self).iterkeys():
@@ -236,6 +446,26 @@ class Model(dict):
     #     return list(self.itervalues())
 
 
+    def _loadMissing(self):
+        '''
+        Completes a partial model by fetching the fields that weren't
+        loaded.
+        '''
+        self._mergeMissing(self._collection._do_getItem(self['id']))
+
+
+    def _mergeMissing(self, data):
+        '''
+        Completes a partial model with the fields from data that weren't
+        loaded. Fields already present on the model are left untouched.
+        '''
+        self._partial = False
+        self._computedCache = None
+        for key, value in (data or {}).iteritems():
+            if not super(Model, self).__contains__(key):
+                super(Model, self).__setitem__(key, value)
+
+
     def isNew(self):
         '''
         Returns true if the model hasn't yet been synchronized to the database.
@@ -243,22 +473,25 @@ class Model(dict):
         return not self.get('id')
 
 
-    def _savePrep(self):
+    def _savePrep(self, newId=None):
         '''
-        prepares a model for saving
+        prepares a model for saving. New models get newId if given, otherwise
+        an id made by the collection.
         '''
         if self._collection == None:
             raise ModelUnexpectedError("Model must be attached to a \
                                         Collection in order to be saved.")
 
+        now = timeutils.format_timestamp(datetime.datetime.utcnow(),
+                                         self._collection.timestampFormat)
         if self.isNew():
-            self.created = timeutils.format_iso_now()
-        self.modified = timeutils.format_iso_now()
+            self.created = now
+        self.modified = now
 
         # set the id
 
         if not 'id' in self:
-            self['id'] = self._collection.makeId(self)
+            self['id'] = newId or self._collection.makeId(self)
 
         # set the class
         
@@ -278,13 +511,45 @@ class Model(dict):
                                            "modelClasses or modelClass")
 
 
-    def save(self):
+    def _needsSave(self, full=False):
+        return full or self.isNew() or self.isDirty()
+
+
+    def _saveUpdate(self, full=False):
+        '''
+        Called after _savePrep. Returns the (sets, unsets) to update the
+        stored document with, or None if the whole model should be saved.
+        '''
+        if full or self.isNew():
+            return None
+        if self._dirty is not None:
+            getvalue = super(Model, self).__getitem__
+            sets = dict((key, getvalue(key)) for key in self._dirty)
+            return sets, list(self._removed)
+        if self._partial:
+            # only update the fields we have, so unloaded ones are kept
+            return dict(self), None
+        return None
+
+
+    def save(self, full=False):
         '''
         Stores the model in a database. First creates an id for the model if
-        one does not exist.
+        one does not exist. Models loaded from the database only write the
+        keys that changed, and nothing if none did, unless full is set.
         '''
+        if not self._needsSave(full):
+            return
+        if full and self._partial:
+            self._loadMissing()
         self._savePrep()
-        self._collection._do_saveModel(self)
+        update = self._saveUpdate(full)
+        if update is None:
+            self._collection._do_saveModel(self)
+        else:
+            sets, unsets = update
+            self._collection._do_updateModel(self['id'], sets, unsets)
+        self._markClean()
 
 
     def fetch(self):
@@ -298,6 +563,8 @@ class Model(dict):
                                        "Collection in order to be fetched.")
 
         self.unpack(**self._collection[self.id])
+        self._partial = False
+        self._markClean()
 
         return self
 
@@ -307,7 +574,10 @@ class Model(dict):
         Just removes itself from the collection. Super classes may override
         to do more stuff, but should always call super().destroy()
         '''
-        if self._collection:
+        if self._collection is not None:
             del self._collection[self.id]
 
 
+def _memoized(name):
+    # reads a memoized computed field through the model's cache
+    return lambda model: model.computeField(name)
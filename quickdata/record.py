@@ -0,0 +1,211 @@
+__all__ = ['Record', 'makeRecordClass']
+
+# marks a field that isn't in the document
+_MISSING = object()
+
+
+class Record(tuple):
+    '''
+    A compact, read-only model loaded by Collection.find(..., records=True)
+    or scan(..., records=True), for reading large result sets.
+
+    Each model class gets a generated Record subclass (see makeRecordClass)
+    storing a document's field values in a tuple, in the order of the class'
+    fields, followed by a dict of any keys that aren't fields (or None).
+    Records have no per-instance dict, so they take a fraction of the
+    memory of a Model. Fields and computed fields are read with dot or item
+    notation like a model's, but methods defined on the model class aren't
+    available: call toModel() for a full, mutable Model.
+    '''
+
+    __slots__ = ()
+
+    # set on the generated subclasses
+    _names = ()
+    _nameSet = frozenset()
+    _index = {}
+    _computed = ()
+    _computedFields = {}
+    _collection = None
+    _modelClass = None
+    _partial = False
+
+
+    @classmethod
+    def _fromData(cls, data):
+        get = data.get
+        values = [get(name, _MISSING) for name in cls._names]
+        extras = None
+        if len(data) > len(cls._nameSet.intersection(data)):
+            index = cls._index
+            extras = dict((k, v) for k, v in data.iteritems()
+                          if k not in index)
+        values.append(extras)
+        return tuple.__new__(cls, values)
+
+
+    @classmethod
+    def _serializer(cls, include_computed=False, classField=None):
+        # lets Collection.toDataMany serialize records
+        return lambda record: record.toData(include_computed)
+
+
+    def _extras(self):
+        return tuple.__getitem__(self, -1) or {}
+
+
+    def __getitem__(self, key):
+        try:
+            pos = self._index[key]
+        except KeyError:
+            if key in self._computedFields:
+                return self._computedFields[key](self)
+            return self._extras()[key]
+        value = tuple.__getitem__(self, pos)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, AttributeError):
+            return default
+
+
+    def __contains__(self, key):
+        pos = self._index.get(key)
+        if pos is None:
+            return key in self._extras()
+        return tuple.__getitem__(self, pos) is not _MISSING
+
+
+    def iteritems(self):
+        for name, value in zip(self._names, tuple.__iter__(self)):
+            if value is not _MISSING:
+                yield name, value
+        for item in self._extras().iteritems():
+            yield item
+
+
+    def iterkeys(self):
+        for key, value in self.iteritems():
+            yield key
+
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+
+    __iter__ = iterkeys
+
+
+    def keys(self):
+        return list(self.iterkeys())
+
+
+    def items(self):
+        return list(self.iteritems())
+
+
+    def values(self):
+        return list(self.itervalues())
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("%s is read-only, use toModel() to change it" %
+                             self.__class__.__name__)
+
+
+    def __setitem__(self, key, value):
+        raise TypeError("%s is read-only, use toModel() to change it" %
+                        self.__class__.__name__)
+
+    __delitem__ = __setitem__
+
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.iteritems()))
+
+
+    def toData(self, include_computed=False):
+        '''
+        Returns the same dictionary as Model.toData.
+        '''
+        data = dict((name, value) for name, value
+                    in zip(self._names, tuple.__iter__(self))
+                    if value is not _MISSING)
+        extras = self._extras()
+        if '_id' in extras:
+            data['_id'] = extras['_id']
+        if include_computed:
+            for name, fn in self._computed:
+                try:
+                    data[name] = fn(self)
+                except (KeyError, AttributeError):
+                    pass
+        return data
+
+
+    def toModel(self):
+        '''
+        Returns a full Model with this record's data, attached to the
+        collection. A record loaded with only some fields gives a partial
+        model, which loads the rest when needed.
+        '''
+        data = dict(self.iteritems())
+        fields = data.keys() if self._partial else None
+        return self._collection._modelFromData(data, fields)
+
+
+# names of Record's own api. Unlike these, tuple's methods (count, index)
+# are hidden by fields of the same name, since a model's fields aren't.
+_RECORD_API = frozenset(dir(Record)) - frozenset(dir(tuple))
+
+
+def _fieldProperty(pos, name):
+    def get(self):
+        value = tuple.__getitem__(self, pos)
+        if value is _MISSING:
+            raise AttributeError("Could not access attribute %s" % name)
+        return value
+    return property(get)
+
+
+def _computedProperty(name, fn):
+    def get(self):
+        try:
+            return fn(self)
+        except KeyError:
+            raise AttributeError("Could not access attribute %s" % name)
+    return property(get)
+
+
+def makeRecordClass(modelClass, collection, partial=False):
+    '''
+    Generates the Record subclass for models of modelClass stored in
+    collection. partial records were loaded with only some of their fields.
+    '''
+    computed = modelClass._computed_fields
+    names = set(modelClass._fields)
+    names.add(collection.classField)
+    names = tuple(sorted(names - modelClass._computedFieldSet))
+    attrs = dict(__slots__=(), _names=names, _nameSet=frozenset(names),
+                 _index=dict((name, i) for i, name in enumerate(names)),
+                 _computed=tuple(computed.items()), _computedFields=computed,
+                 _collection=collection, _modelClass=modelClass,
+                 _partial=partial)
+    # like a model's fields, fields don't hide its methods of the same name
+    for i, name in enumerate(names):
+        if name not in _RECORD_API:
+            attrs[name] = _fieldProperty(i, name)
+    for name, fn in computed.iteritems():
+        if name not in _RECORD_API:
+            attrs[name] = _computedProperty(name, fn)
+    return type(modelClass.__name__ + 'Record', (Record,), attrs)
@@ -1,5 +1,19 @@
+import Queue
+import cPickle
+import errno
+import os
+import sqlite3
+import stat
+import sys
+import threading
+from collections import OrderedDict
 from time import time
 
+import metricutils
+
+_missing = object()
+
+
 class memoize_with_expiry(object):
     '''
     Modified from django.utils.functional.memoize to add cache expiry.
@@ -9,28 +23,508 @@ class memoize_with_expiry(object):
     keys. Only cache results younger than expiry_time (seconds) will be returned.
 
     Only the first num_args are considered when creating the key.
+
+    When several threads miss the same key at once only one of them calls
+    the function, and the others wait for its result.
     '''
     def __init__(self, cache, expiry_time=0, num_args=None):
         self.cache = cache
         self.expiry_time = expiry_time
         self.num_args = num_args
+        self.flights = SingleFlight()
 
     def __call__(self, func):
+        def load(mem_args, args):
+            result = func(*args)
+            self.cache[mem_args] = (result, time())
+            return result
+
         def wrapped(*args):
             # The *args list will act as the cache key (at least the first part of it)
             # [:None] is equivalent to [:]
             mem_args = (func.__name__,)+args[:self.num_args]
             # Check the cache
-            if mem_args in self.cache:
-                result, timestamp = self.cache[mem_args]
+            entry = self.cache.get(mem_args)
+            if entry is not None:
+                result, timestamp = entry
                 # Check the age.
                 age = time() - timestamp
                 if not self.expiry_time or age < self.expiry_time:
                     return result
-            # Get a new result
-            result = func(*args)
-            # Cache it
-            self.cache[mem_args] = (result, time())
-            # and return it.
-            return result
-        return wrapped
\ No newline at end of file
+            # Get a new result, once however many threads are asking
+            return self.flights.do(mem_args, load, mem_args, args)
+        return wrapped
+
+
+class SingleFlight(object):
+    '''
+    Runs at most one call per key at a time. Callers asking for a key that
+    is already being loaded wait for that call and share its result (or
+    its exception) instead of making their own. Calls for different keys
+    don't wait for each other.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            return call.wait()
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException:
+            call.error = sys.exc_info()[1]
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.release()
+
+
+class _Call(object):
+
+    def __init__(self):
+        # held until the call finishes. A plain lock is much cheaper to
+        # make than an Event, and this is made on every cache miss.
+        self.done = threading.Lock()
+        self.done.acquire()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        with self.done:
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+def approx_sizeof(obj, _seen=None):
+    '''
+    Returns a rough estimate of the number of bytes held by obj, following
+    the contents of dicts, lists, tuples and sets.
+    '''
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += approx_sizeof(k) + approx_sizeof(v)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += approx_sizeof(v)
+    return size
+
+
+class LRUCache(object):
+    '''
+    A dictionary-like cache bounded by number of entries and approximate size
+    in bytes. When either bound is exceeded the least recently used entries
+    are evicted. Entries older than expiry_time (seconds) are treated as
+    missing. A bound or expiry_time of None (or 0) disables that limit.
+    Safe to use from several threads.
+    '''
+
+    def __init__(self, max_entries=None, max_bytes=None, expiry_time=0,
+                 sizeof=approx_sizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.expiry_time = expiry_time
+        self.sizeof = sizeof
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # key -> (value, timestamp, size)
+            self.entries = OrderedDict()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def get(self, key, default=None):
+        entry = self.getEntry(key)
+        return default if entry is None else entry[0]
+
+    def getEntry(self, key):
+        '''
+        Like get, but returns (value, time stored) or None if missing.
+        '''
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            value, timestamp, size = entry
+            if self.expiry_time and time() - timestamp >= self.expiry_time:
+                self.bytes -= size
+                self.misses += 1
+                return None
+            # re-insert to mark as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return value, timestamp
+
+    def set(self, key, value):
+        # sized outside the lock, it's the slow part
+        size = self.sizeof(value) if self.max_bytes else 0
+        with self.lock:
+            self._delete(key)
+            if self.max_bytes and size > self.max_bytes:
+                return
+            self.entries[key] = (value, time(), size)
+            self.bytes += size
+            self._evict()
+
+    def delete(self, key):
+        with self.lock:
+            return self._delete(key)
+
+    def _delete(self, key):
+        try:
+            value, timestamp, size = self.entries.pop(key)
+        except KeyError:
+            return False
+        self.bytes -= size
+        return True
+
+    def stats(self):
+        with self.lock:
+            return dict(entries=len(self.entries), bytes=self.bytes, 
+                        hits=self.hits, misses=self.misses, 
+                        evictions=self.evictions)
+
+    def _evict(self):
+        while self.entries and \
+              ((self.max_entries and len(self.entries) > self.max_entries) or\
+               (self.max_bytes and self.bytes > self.max_bytes)):
+            key, (value, timestamp, size) = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+_SHARED_CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    stored REAL NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (namespace, key)
+)'''
+
+
+class SharedCache(object):
+    '''
+    A cache shared by every process on a host, stored in a sqlite database
+    file that each process maps into memory. Values are pickled. Use
+    namespace(name) to get a view with the get/set/delete interface of
+    LRUCache, whose keys don't clash with other namespaces' keys:
+
+    cache = SharedCache('/var/lib/app/things.cache', max_entries=100000)
+    Things().setBackend(CachedMongoBackend, cache=cache, **mongo_stuff)
+
+    Entries older than expiry_time (seconds) are treated as missing. The
+    bounds (max_entries and max_bytes, across all namespaces) are enforced
+    every sweep_every sets by each process, evicting the entries stored
+    longest ago. Unlike LRUCache reads don't reorder entries, which would
+    mean a write shared between processes on every hit.
+
+    Since unpickling can run arbitrary code, the file must be a regular file
+    owned by the current user and not writable by anyone else, or IOError
+    is raised. New files are created readable only by their owner. Keep it
+    in a directory other users can't write to, not in /tmp.
+    '''
+
+    def __init__(self, path, max_entries=None, max_bytes=None,
+                 expiry_time=0, mmap_size=256 * 1024 * 1024, sweep_every=256,
+                 timeout=5.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.expiry_time = expiry_time
+        self.mmap_size = mmap_size
+        self.sweep_every = sweep_every
+        self.timeout = timeout
+        self.evictions = 0
+        self._sets = 0
+        self._local = threading.local()
+        self._create()
+        self._execute(_SHARED_CACHE_SCHEMA)
+
+    def _create(self):
+        if self.path == ':memory:':
+            return
+        try:
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL,
+                             0o600))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _checkFiles(self):
+        # the database and its WAL files, which another user could have
+        # created first to get their pickles loaded
+        if self.path == ':memory:':
+            return
+        for path in (self.path, self.path + '-wal', self.path + '-shm'):
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or \
+               st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                raise IOError("%s must be a regular file owned by this user "
+                              "and writable only by it" % path)
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, or carried
+        # across a fork
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, 'pid', None) != pid:
+            self._checkFiles()
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.text_factory = str
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA mmap_size=%d' % self.mmap_size)
+            local.conn = conn
+            local.pid = pid
+        return local.conn
+
+    def _execute(self, sql, params=()):
+        return self._connection().execute(sql, params)
+
+    def namespace(self, name):
+        return SharedCacheNamespace(self, name)
+
+    def _get(self, namespace, key):
+        # returns (pickled value, time stored) or None
+        sql = 'SELECT value, stored FROM cache WHERE namespace=? AND key=?'
+        params = [namespace, key]
+        if self.expiry_time:
+            sql += ' AND stored>?'
+            params.append(time() - self.expiry_time)
+        return self._execute(sql, params).fetchone()
+
+    def _set(self, namespace, key, value):
+        if self.max_bytes and len(value) > self.max_bytes:
+            self._delete(namespace, key)
+            return
+        self._execute('INSERT OR REPLACE INTO cache '
+                      '(namespace, key, value, stored, size) '
+                      'VALUES (?, ?, ?, ?, ?)',
+                      (namespace, key, sqlite3.Binary(value), time(),
+                       len(value)))
+        self._sets += 1
+        if self._sets >= self.sweep_every:
+            self._sets = 0
+            self.sweep()
+
+    def _delete(self, namespace, key):
+        cursor = self._execute('DELETE FROM cache WHERE namespace=? AND key=?',
+                               (namespace, key))
+        return cursor.rowcount > 0
+
+    def sweep(self):
+        '''
+        Removes expired entries, then the oldest entries until the cache is
+        within its bounds. Called automatically as entries are set.
+        '''
+        conn = self._connection()
+        evicted = 0
+        if self.expiry_time:
+            evicted += conn.execute('DELETE FROM cache WHERE stored<=?',
+                                    (time() - self.expiry_time,)).rowcount
+        if self.max_entries:
+            count, = conn.execute('SELECT COUNT(*) FROM cache').fetchone()
+            if count > self.max_entries:
+                evicted += conn.execute(
+                    'DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache '
+                    'ORDER BY stored LIMIT ?)',
+                    (count - self.max_entries,)).rowcount
+        if self.max_bytes:
+            total, = conn.execute('SELECT SUM(size) FROM cache').fetchone()
+            excess = (total or 0) - self.max_bytes
+            if excess > 0:
+                rowids = []
+                for rowid, size in conn.execute(
+                        'SELECT rowid, size FROM cache ORDER BY stored'):
+                    rowids.append(rowid)
+                    excess -= size
+                    if excess <= 0:
+                        break
+                for rowid in rowids:
+                    conn.execute('DELETE FROM cache WHERE rowid=?', (rowid,))
+                evicted += len(rowids)
+        self.evictions += evicted
+        return evicted
+
+    def clear(self, namespace=None):
+        if namespace is None:
+            self._execute('DELETE FROM cache')
+        else:
+            self._execute('DELETE FROM cache WHERE namespace=?', (namespace,))
+
+    def stats(self, namespace=None):
+        sql = 'SELECT COUNT(*), SUM(size) FROM cache'
+        params = ()
+        if namespace is not None:
+            sql += ' WHERE namespace=?'
+            params = (namespace,)
+        entries, size = self._execute(sql, params).fetchone()
+        return dict(entries=entries, bytes=size or 0,
+                    evictions=self.evictions)
+
+
+
+class SharedCacheNamespace(object):
+    '''
+    The part of a SharedCache used by one collection, with the interface of
+    LRUCache. Hits and misses are counted per process.
+    '''
+
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(key):
+        # ids loaded from the database are often unicode where the caller's
+        # are str, both should find the same entry
+        if isinstance(key, basestring):
+            return 's:' + (key.encode('utf-8') if isinstance(key, unicode)
+                           else key)
+        return 'r:' + repr(key)
+
+    def __len__(self):
+        return self.stats()['entries']
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    @property
+    def expiry_time(self):
+        return self.cache.expiry_time
+
+    def get(self, key, default=None):
+        entry = self.getEntry(key)
+        return default if entry is None else entry[0]
+
+    def getEntry(self, key):
+        row = self.cache._get(self.name, self._key(key))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cPickle.loads(str(row[0])), row[1]
+
+    def set(self, key, value):
+        self.cache._set(self.name, self._key(key),
+                        cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+
+    def delete(self, key):
+        return self.cache._delete(self.name, self._key(key))
+
+    def clear(self):
+        self.cache.clear(self.name)
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        stats = self.cache.stats(self.name)
+        stats.update(hits=self.hits, misses=self.misses)
+        return stats
+
+
+class Refresher(object):
+    '''
+    Reloads cache entries in a small pool of background threads, so that
+    hot entries can be refreshed before they expire while the cached value
+    is still served. At most maxPending refreshes are queued or running;
+    further requests are dropped until the queue drains. A key already
+    queued isn't queued again.
+    '''
+
+    def __init__(self, workers=2, maxPending=100, name=None):
+        self.workers = workers
+        self.maxPending = maxPending
+        self.name = name
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # also used after a fork, which doesn't copy the worker threads
+        self.pid = os.getpid()
+        self.queue = Queue.Queue()
+        self.pending = set()
+        self.threads = []
+        self.refreshes = 0
+        self.failures = 0
+        self.dropped = 0
+        self.lastError = None
+
+    def request(self, key, fn, *args):
+        '''
+        Queues fn(*args) to refresh key. Returns False if the key is already
+        queued or the queue is full.
+        '''
+        with self.lock:
+            if self.pid != os.getpid():
+                self._reset()
+            if key in self.pending:
+                return False
+            if len(self.pending) >= self.maxPending:
+                self.dropped += 1
+                return False
+            self.pending.add(key)
+            if not self.threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._run,
+                                              name='refresh-%s' % self.name)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+        self.queue.put((key, fn, args))
+        return True
+
+    def _run(self):
+        while True:
+            key, fn, args = self.queue.get()
+            start = time()
+            try:
+                fn(*args)
+            except Exception as e:
+                with self.lock:
+                    self.failures += 1
+                    self.lastError = e
+            else:
+                with self.lock:
+                    self.refreshes += 1
+                if metricutils.sinks:
+                    metricutils.emit('cacheRefresh', self.name, time() - start,
+                                     1)
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+
+    def stats(self):
+        with self.lock:
+            return dict(pending=len(self.pending), refreshes=self.refreshes,
+                        failures=self.failures, dropped=self.dropped,
+                        lastError=self.lastError)
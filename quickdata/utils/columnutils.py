@@ -0,0 +1,181 @@
+import datetime
+
+import timeutils
+
+## COLUMNS --------------------------------------------------------------------
+#
+# Builds numpy columns from streams of documents, for Collection.findColumns.
+# numpy is only imported when columns are built, so it stays an optional
+# dependency.
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("findColumns requires numpy")
+    return numpy
+
+
+def field_getter(field):
+    '''
+    Returns a function getting a (possibly dotted) field's value from a
+    document, or None if it's missing.
+    '''
+    parts = field.split('.')
+    if len(parts) == 1:
+        return lambda data: data.get(field)
+
+    def get(data):
+        for part in parts:
+            if not isinstance(data, dict):
+                return None
+            data = data.get(part)
+        return data
+    return get
+
+
+def infer_dtype(values):
+    '''
+    Returns the numpy dtype for a list of python values (None for missing),
+    or None if they are all missing. Booleans, integers, floats and
+    datetimes get typed columns, anything else is stored as objects.
+    '''
+    kinds = set(type(value) for value in values if value is not None)
+    if not kinds:
+        return None
+    if kinds == set([bool]):
+        return 'bool'
+    if kinds <= set([int, long]):
+        return 'int64'
+    if kinds <= set([int, long, float]):
+        return 'float64'
+    if kinds == set([datetime.datetime]):
+        return 'datetime64[us]'
+    return 'object'
+
+
+def _unify(np, dtypes):
+    dtypes = set(np.dtype(dtype) for dtype in dtypes if dtype is not None)
+    if not dtypes:
+        return np.dtype('object')
+    if len(dtypes) == 1:
+        return dtypes.pop()
+    if all(dtype.kind in 'iuf' for dtype in dtypes):
+        return np.dtype('float64')
+    return np.dtype('object')
+
+
+def _to_datetimes(np, values, dtype):
+    # accepts datetimes, iso strings and epoch milliseconds, the ways
+    # Collection.timestampFormat stores timestamps
+    result = []
+    for value in values:
+        if isinstance(value, basestring):
+            value = timeutils.parse_iso_datetime(value,
+                                                 timeutils.utc_timezone)
+        elif isinstance(value, (int, long, float)):
+            value = timeutils.parse_timestamp(value, timeutils.utc_timezone)
+        elif isinstance(value, datetime.datetime) and value.tzinfo:
+            value = timeutils.parse_timestamp(value, timeutils.utc_timezone)
+        result.append(value)
+    return np.array(result, dtype=dtype)
+
+
+def _to_array(np, values, dtype):
+    if dtype.kind == 'M':
+        return _to_datetimes(np, values, dtype)
+    if dtype.kind == 'O':
+        # assigned one by one so that list values aren't taken as dimensions
+        array = np.empty(len(values), dtype=dtype)
+        for i, value in enumerate(values):
+            array[i] = value
+        return array
+    return np.array(values, dtype=dtype)
+
+
+class ColumnBuilder(object):
+    '''
+    Accumulates one field's values a batch at a time. Each batch becomes a
+    numpy array (and a mask of the missing values) as soon as it arrives,
+    so python values are only held for one batch. dtype fixes the column's
+    type; otherwise it is inferred per batch and the batches are unified
+    when the column is built.
+    '''
+
+    def __init__(self, dtype=None):
+        self.np = _numpy()
+        self.dtype = None if dtype is None else self.np.dtype(dtype)
+        self.chunks = []
+
+    def extend(self, values):
+        np = self.np
+        mask = np.fromiter((value is None for value in values), dtype=bool,
+                           count=len(values))
+        dtype = self.dtype or infer_dtype(values)
+        if dtype is None:
+            # all missing, typed once the column is built
+            self.chunks.append((None, values, mask))
+            return
+        dtype = np.dtype(dtype)
+        if mask.any():
+            fill = None if dtype.kind == 'O' else \
+                   np.zeros(1, dtype=dtype)[0].item()
+            values = [fill if value is None else value for value in values]
+        try:
+            array = _to_array(np, values, dtype)
+        except (OverflowError, ValueError, TypeError):
+            if self.dtype is not None:
+                raise
+            # inferred, like integers too large for int64
+            array = _to_array(np, values, np.dtype('object'))
+        self.chunks.append((array, None, mask))
+
+    def build(self):
+        '''
+        Returns the column as a numpy masked array, masking missing values.
+        '''
+        np = self.np
+        dtype = self.dtype or _unify(np, [array.dtype for array, values, mask
+                                          in self.chunks if array is not None])
+        arrays = []
+        for array, values, mask in self.chunks:
+            if array is None:
+                array = np.zeros(len(values), dtype=dtype)
+                if dtype.kind == 'O':
+                    array[:] = None
+            arrays.append(array.astype(dtype, copy=False))
+        if arrays:
+            data = np.concatenate(arrays)
+            mask = np.concatenate([mask for array, values, mask
+                                   in self.chunks])
+        else:
+            data = np.zeros(0, dtype=dtype)
+            mask = np.zeros(0, dtype=bool)
+        return np.ma.MaskedArray(data, mask=mask)
+
+
+def build_columns(docs, fields, dtypes=None, batchSize=1000):
+    '''
+    Reads an iterator of documents batchSize at a time into a dict mapping
+    each of fields to a numpy masked array. dtypes optionally maps fields
+    to the numpy dtype of their column.
+    '''
+    dtypes = dtypes or {}
+    getters = [(field, field_getter(field)) for field in fields]
+    builders = dict((field, ColumnBuilder(dtypes.get(field)))
+                    for field in fields)
+    batch = []
+    for data in docs:
+        batch.append(data)
+        if len(batch) >= batchSize:
+            _add_batch(builders, getters, batch)
+            batch = []
+    if batch:
+        _add_batch(builders, getters, batch)
+    return dict((field, builder.build())
+                for field, builder in builders.iteritems())
+
+
+def _add_batch(builders, getters, batch):
+    for field, get in getters:
+        builders[field].extend([get(data) for data in batch])
@@ -0,0 +1,142 @@
+import os
+import random
+import socket
+import string
+import threading
+import time
+import zlib
+
+import randutils
+
+## ID GENERATORS --------------------------------------------------------------
+#
+# An id generator provides next_id() and next_ids(count). Generators whose
+# ids can never collide set unique = True, which lets a collection skip
+# checking the database for an existing id.
+
+class RandomIdGenerator(object):
+    '''
+    Generates random ids. These may (rarely) collide, so collections check
+    new ids against the database.
+    '''
+    unique = False
+
+    def __init__(self, size=12, valid_chars=string.ascii_lowercase+\
+                                            string.digits):
+        self.size = size
+        self.valid_chars = valid_chars
+
+    def next_id(self):
+        return unicode(randutils.gen_random_str(self.size, self.valid_chars))
+
+    def next_ids(self, count):
+        return [self.next_id() for x in range(count)]
+
+
+# base32 digits in ascii order, so encoded numbers sort like the numbers
+SORTABLE_DIGITS = '0123456789abcdefghijklmnopqrstuv'
+
+
+def encode_sortable(value, width):
+    digits = []
+    for x in range(width):
+        digits.append(SORTABLE_DIGITS[value & 31])
+        value >>= 5
+    return ''.join(reversed(digits))
+
+
+class SortableIdGenerator(object):
+    '''
+    Generates k-sortable ids that need no coordination: a millisecond
+    timestamp, then a node component identifying the generating process,
+    then a counter for ids made within the same millisecond. Ids sort by
+    creation time as strings.
+
+    The node defaults to a hash of the hostname and process id mixed with
+    random bits. Two processes can still (very rarely) get the same node,
+    so collections keep checking new ids against the database. Pass an
+    explicit node number (less than 2**30) that is distinct for every live
+    process to rule out collisions entirely; the ids are then unique and
+    collections skip that check.
+
+    With an explicit node, build the generator in the process that uses it,
+    after any fork. A generator inherited across a fork can't tell whether
+    its node is still distinct, since every child got the same one, so it
+    falls back to the default node and stops claiming unique ids.
+    '''
+
+    TIME_DIGITS = 9     # 45 bits of milliseconds
+    NODE_DIGITS = 6     # 30 bits
+    COUNTER_DIGITS = 4  # 20 bits
+
+    def __init__(self, node=None):
+        self.node = node
+        self._unique = node is not None
+        self._pid = None
+        self._check_fork()
+
+    @property
+    def unique(self):
+        self._check_fork()
+        return self._unique
+
+    def _check_fork(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            # new process: new node component and fresh state
+            if self._pid is not None and self.node is not None:
+                # forked children share the explicit node
+                self.node = None
+                self._unique = False
+            self._pid = pid
+            self._lock = threading.Lock()
+            self._last = 0
+            self._counter = 0
+            node = self.node
+            if node is None:
+                node = zlib.crc32('%s:%d' % (socket.gethostname(), pid)) ^ \
+                       random.SystemRandom().getrandbits(30)
+            self._node_part = encode_sortable(node & (2**30-1),
+                                              self.NODE_DIGITS)
+
+    def _reserve(self, count):
+        '''
+        Reserves count consecutive (timestamp, counter) slots. Returns a list
+        of (timestamp, first counter, number of ids) blocks.
+        '''
+        maxcount = 2**(5*self.COUNTER_DIGITS)
+        blocks = []
+        with self._lock:
+            while count:
+                now = int(time.time()*1000)
+                if now > self._last:
+                    self._last = now
+                    self._counter = 0
+                elif self._counter >= maxcount:
+                    # counter exhausted (or the clock went backwards),
+                    # move on to the next millisecond
+                    self._last += 1
+                    self._counter = 0
+                n = min(count, maxcount - self._counter)
+                blocks.append((self._last, self._counter, n))
+                self._counter += n
+                count -= n
+        return blocks
+
+    def next_id(self):
+        return self.next_ids(1)[0]
+
+    def next_ids(self, count):
+        '''
+        Returns a block of count ids, in increasing order.
+        '''
+        self._check_fork()
+        ids = []
+        for stamp, first, n in self._reserve(count):
+            prefix = encode_sortable(stamp, self.TIME_DIGITS) + \
+                     self._node_part
+            for counter in xrange(first, first+n):
+                ids.append(unicode(prefix +
+                                   encode_sortable(counter,
+                                                   self.COUNTER_DIGITS)))
+        return ids
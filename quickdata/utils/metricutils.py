@@ -0,0 +1,191 @@
+import functools
+import threading
+
+from bisect import bisect_left
+from collections import namedtuple
+from time import time
+
+## EVENTS ---------------------------------------------------------------------
+#
+# Instrumented operations emit an Event to every registered sink. A sink is
+# any callable taking the event. When no sinks are registered instrumented
+# operations only pay for checking the sinks list.
+
+Event = namedtuple('Event', 'op collection latency count cache')
+
+sinks = []
+
+
+def add_sink(sink):
+    sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    try:
+        sinks.remove(sink)
+    except ValueError:
+        pass
+
+
+def emit(op, collection, latency, count=None, cache=None):
+    '''
+    Sends an event to the sinks. latency is in seconds, count is the number
+    of documents involved, and cache is 'hit' or 'miss' for cache lookups.
+    '''
+    event = Event(op, collection, latency, count, cache)
+    for sink in list(sinks):
+        sink(event)
+
+
+## INSTRUMENTATION ------------------------------------------------------------
+
+COUNTERS = {
+    # number of documents given the result and the call arguments
+    'one':    lambda result, args: 1 if result else 0,
+    'result': lambda result, args: len(result),
+    'arg':    lambda result, args: len(args[0]),
+}
+
+
+def _timed_iter(op, collection, iterator, batches):
+    # times only the work done producing each item, not the consumer's
+    count = 0
+    latency = 0
+    try:
+        while True:
+            start = time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                latency += time() - start
+                return
+            latency += time() - start
+            count += len(item) if batches else 1
+            yield item
+    finally:
+        emit(op, collection, latency, count)
+
+
+def instrumented(op, count=None, stream=False, batches=False):
+    '''
+    Decorates a Collection method so that each call emits an event named op
+    for the collection when sinks are registered. count names one of the
+    COUNTERS used to count documents. If stream is set the method returns
+    an iterator, and the event is emitted once it is exhausted or closed,
+    counting its items (or the lengths of its items if batches is set).
+    '''
+    counter = COUNTERS.get(count)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapped(self, *args, **kwargs):
+            if not sinks:
+                return fn(self, *args, **kwargs)
+            collection = self.__class__.__name__
+            if stream:
+                return _timed_iter(op, collection,
+                                   iter(fn(self, *args, **kwargs)), batches)
+            start = time()
+            result = fn(self, *args, **kwargs)
+            latency = time() - start
+            emit(op, collection, latency,
+                 counter(result, args) if counter else None)
+            return result
+        return wrapped
+    return decorator
+
+
+## AGGREGATION ----------------------------------------------------------------
+
+# histogram bucket upper bounds in seconds: 1us doubling up to about 67s
+BUCKETS = [1e-6 * 2**k for k in range(27)]
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.n = 0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.n += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        '''
+        Returns the upper bound of the bucket holding the p-th percentile.
+        '''
+        if not self.n:
+            return None
+        rank = p / 100.0 * self.n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+
+class Aggregator(object):
+    '''
+    A sink that aggregates events in process, per collection and operation:
+    calls, documents, cache hits and misses, and a latency histogram.
+
+    aggregator = metricutils.add_sink(metricutils.Aggregator())
+    ...
+    print aggregator.dump()
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def __call__(self, event):
+        key = (event.collection, event.op)
+        with self.lock:
+            try:
+                stats = self.stats[key]
+            except KeyError:
+                stats = self.stats[key] = dict(calls=0, docs=0, hits=0,
+                                               misses=0,
+                                               latency=Histogram())
+            stats['calls'] += 1
+            if event.count:
+                stats['docs'] += event.count
+            if event.cache == 'hit':
+                stats['hits'] += event.count or 1
+            elif event.cache == 'miss':
+                stats['misses'] += event.count or 1
+            stats['latency'].add(event.latency)
+
+    def dump(self, reset=False):
+        '''
+        Returns a dict mapping 'collection.op' to that operation's stats,
+        with latencies in seconds. If reset is set the stats start over.
+        '''
+        with self.lock:
+            result = {}
+            for (collection, op), stats in self.stats.iteritems():
+                hist = stats['latency']
+                result['%s.%s' % (collection, op)] = dict(
+                    calls=stats['calls'], docs=stats['docs'],
+                    hits=stats['hits'], misses=stats['misses'],
+                    total=hist.total, mean=hist.total / hist.n,
+                    p50=hist.percentile(50), p90=hist.percentile(90),
+                    p99=hist.percentile(99), max=hist.max,
+                    histogram=[(bound, count) for bound, count 
+                               in zip(BUCKETS + [None], hist.counts)
+                               if count])
+            if reset:
+                self.stats = {}
+        return result
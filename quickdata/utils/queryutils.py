@@ -0,0 +1,213 @@
+import re
+import datetime
+
+import errorutils
+
+## VALUE HELPERS --------------------------------------------------------------
+
+def type_rank(value):
+    '''
+    Returns a number grouping values that can be meaningfully ordered against
+    each other (numbers, strings, datetimes), or None for other types. Like
+    mongo, range comparisons only match values of the same group.
+    '''
+    if isinstance(value, bool):
+        return 4
+    if isinstance(value, (int, long, float)):
+        return 1
+    if isinstance(value, basestring):
+        return 2
+    if isinstance(value, datetime.datetime):
+        return 3
+    return None
+
+
+def get_path(doc, path):
+    '''
+    Returns the list of values found at a dotted path in doc. Lists found
+    along the way are expanded, so 'a.b' matches every 'b' within a list
+    stored under 'a'. Returns an empty list if the path doesn't exist.
+    '''
+    values = [doc]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                else:
+                    for item in value:
+                        if isinstance(item, dict) and part in item:
+                            found.append(item[part])
+        values = found
+        if not values:
+            break
+    return values
+
+
+def _candidates(values):
+    # a condition matches either a value itself or any element of a list value
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            for item in value:
+                yield item
+
+
+## OPERATORS ------------------------------------------------------------------
+
+def _compare(op):
+    def compare(values, arg):
+        rank = type_rank(arg)
+        if rank is None:
+            return False
+        return any(type_rank(v) == rank and op(v, arg)
+                   for v in _candidates(values))
+    return compare
+
+
+def _equal(a, b):
+    # like mongo, booleans never equal numbers
+    return a == b and isinstance(a, bool) == isinstance(b, bool)
+
+
+def _eq(values, arg):
+    if arg is None and not values:
+        return True
+    return any(_equal(v, arg) for v in _candidates(values))
+
+
+def _in(values, arg):
+    return any(_eq(values, a) for a in arg)
+
+
+def _regex(values, arg, options=''):
+    flags = 0
+    for opt in options:
+        flags |= {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}.get(opt, 0)
+    pattern = re.compile(arg, flags) if isinstance(arg, basestring) else arg
+    return any(isinstance(v, basestring) and pattern.search(v)
+               for v in _candidates(values))
+
+
+def _all(values, arg):
+    return all(_eq(values, a) for a in arg)
+
+
+def _size(values, arg):
+    return any(isinstance(v, list) and len(v) == arg for v in values)
+
+
+def _elem_match(values, arg):
+    for value in values:
+        if isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict) and match_query(arg, item):
+                    return True
+    return False
+
+
+OPERATORS = {
+    '$eq':  _eq,
+    '$ne':  lambda values, arg: not _eq(values, arg),
+    '$gt':  _compare(lambda a, b: a > b),
+    '$gte': _compare(lambda a, b: a >= b),
+    '$lt':  _compare(lambda a, b: a < b),
+    '$lte': _compare(lambda a, b: a <= b),
+    '$in':  _in,
+    '$nin': lambda values, arg: not _in(values, arg),
+    '$exists': lambda values, arg: bool(values) == bool(arg),
+    '$not': lambda values, arg: not match_condition(values, arg),
+    '$all': _all,
+    '$size': _size,
+    '$elemMatch': _elem_match,
+}
+
+
+class QueryError(errorutils.UnexpectedError):
+    pass
+
+
+def is_regex(value):
+    '''
+    Returns true for a compiled regular expression, which used as a plain
+    condition matches strings instead of comparing equal.
+    '''
+    return hasattr(value, 'search') and hasattr(value, 'pattern')
+
+
+def is_operator_dict(cond):
+    return isinstance(cond, dict) and cond and \
+           all(k.startswith('$') for k in cond)
+
+
+def match_condition(values, cond):
+    '''
+    Tests the values found at a path against a condition, which is either a
+    plain value to compare for equality or a dict of operators.
+    '''
+    if not is_operator_dict(cond):
+        if is_regex(cond):
+            return _regex(values, cond)
+        return _eq(values, cond)
+    for op, arg in cond.iteritems():
+        if op == '$regex':
+            if not _regex(values, arg, cond.get('$options', '')):
+                return False
+        elif op == '$options':
+            continue
+        else:
+            try:
+                fn = OPERATORS[op]
+            except KeyError:
+                raise QueryError("unsupported query operator %s" % op)
+            if not fn(values, arg):
+                return False
+    return True
+
+
+def match_query(query, doc):
+    '''
+    Returns True if doc matches a mongo style query. Supports the comparison
+    operators, $in/$nin, $exists, $regex, $all, $size, $elemMatch, $not and
+    the logical operators $and, $or and $nor over dotted paths.
+    '''
+    for key, cond in query.iteritems():
+        if key == '$and':
+            if not all(match_query(q, doc) for q in cond):
+                return False
+        elif key == '$or':
+            if not any(match_query(q, doc) for q in cond):
+                return False
+        elif key == '$nor':
+            if any(match_query(q, doc) for q in cond):
+                return False
+        elif key.startswith('$'):
+            raise QueryError("unsupported query operator %s" % key)
+        elif not match_condition(get_path(doc, key), cond):
+            return False
+    return True
+
+
+def normalize_query(value):
+    '''
+    Returns a hashable form of a query (or any part of one) usable as a
+    cache key. Queries that match the same documents given in a different
+    key order normalize equally. Raises TypeError for values that can't be
+    hashed.
+    '''
+    if isinstance(value, dict):
+        return ('{}',) + tuple(sorted((k, normalize_query(v))
+                                      for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return ('[]',) + tuple(normalize_query(v) for v in value)
+    if isinstance(value, bool):
+        # True == 1 in python, but not in a query
+        return ('bool', value)
+    if is_regex(value):
+        return ('re', value.pattern, value.flags)
+    hash(value)
+    return value
@@ -2,6 +2,7 @@
 # floating point division between integers
 from __future__ import division
 
+import calendar
 import datetime
 import time
 import re
@@ -32,6 +33,7 @@ class LocalTimezone(datetime.tzinfo):
         else:
             self._dst_offset = self._std_offset
         self._dst_diff = self._dst_offset - self._std_offset
+        self._dst_cache = {}
 
     def utcoffset(self, dt):
         if self._isdst(dt):
@@ -49,12 +51,21 @@ class LocalTimezone(datetime.tzinfo):
         return time.tzname[self._isdst(dt)]
 
     def _isdst(self, dt):
+        # dst changes on the hour, so the answer is cached per hour
+        key = (dt.year, dt.month, dt.day, dt.hour)
+        try:
+            return self._dst_cache[key]
+        except KeyError:
+            pass
         tt = (dt.year, dt.month, dt.day,
               dt.hour, dt.minute, dt.second,
               dt.weekday(), 0, 0)
         stamp = time.mktime(tt)
         tt = time.localtime(stamp)
-        return tt.tm_isdst > 0
+        if len(self._dst_cache) > 10000:
+            self._dst_cache.clear()
+        self._dst_cache[key] = isdst = tt.tm_isdst > 0
+        return isdst
 
 local_timezone = LocalTimezone()
 
@@ -64,15 +75,57 @@ class UTCRequiredException(Exception):
         return "datetime string must be in UTC time. (trailing 'Z' required)"
 
 
+def _parse_iso_utc(dtstring):
+    """ Parses an UTC timezone string in iso format (with a trailing 'Z') into
+        a naive datetime in UTC. """
+    if dtstring[-1] != 'Z':
+        raise UTCRequiredException()
+    # fast path for the fixed layout written by format_iso and isoformat():
+    # YYYY-MM-DDTHH:MM:SS[.ffffff]Z
+    if len(dtstring) >= 20 and dtstring[10] == 'T' and \
+       (len(dtstring) == 20 or dtstring[19] == '.'):
+        try:
+            micros = dtstring[20:-1]
+            return datetime.datetime(int(dtstring[0:4]), int(dtstring[5:7]),
+                                     int(dtstring[8:10]),
+                                     int(dtstring[11:13]),
+                                     int(dtstring[14:16]),
+                                     int(dtstring[17:19]),
+                                     int((micros+'000000')[:6]) if micros 
+                                     else 0)
+        except ValueError:
+            pass
+    return datetime.datetime(*map(int, re.split('[^\d]',dtstring)[:-1]))
+
+
+def _from_utc(dt, tzinfo):
+    if tzinfo is utc_timezone:
+        return dt
+    dt = dt.replace(tzinfo=utc_timezone)
+    return dt.astimezone(tzinfo).replace(tzinfo=None)
+
+
 def parse_iso_datetime(dtstring, tzinfo=local_timezone):
     """ Expects an UTC timezone string in iso format (with a trailing 'Z'). 
         Returns a naive datetime object after first converting to tzinfo. 
         Similar to what you'd get from datetime.now() """
-    if dtstring[-1] != 'Z':
-        raise UTCRequiredException()
-    dt = datetime.datetime(*map(int, re.split('[^\d]',dtstring)[:-1]), 
-                           tzinfo=utc_timezone)
-    return dt.astimezone(tzinfo).replace(tzinfo=None)
+    return _from_utc(_parse_iso_utc(dtstring), tzinfo)
+
+
+def parse_iso_datetimes(dtstrings, tzinfo=local_timezone):
+    """ Like parse_iso_datetime for a sequence of strings, returning a list.
+        The tzinfo offset is only looked up once per UTC hour. """
+    offsets = {}
+    result = []
+    for dtstring in dtstrings:
+        dt = _parse_iso_utc(dtstring)
+        hour = dt.replace(minute=0, second=0, microsecond=0)
+        try:
+            offset = offsets[hour]
+        except KeyError:
+            offset = offsets[hour] = _from_utc(hour, tzinfo) - hour
+        result.append(dt + offset)
+    return result
 
 
 def format_iso_now():
@@ -81,6 +134,43 @@ def format_iso_now():
     return datetime.datetime.utcnow().isoformat()+'Z'
 
 
+## TIMESTAMP STORAGE ----------------------------------------------------------
+#
+# Timestamps can be stored as iso strings (the default), as native datetimes
+# (naive, in UTC) that the database stores as dates, or as integer
+# milliseconds since the epoch. The latter two can be indexed and compared by
+# the database without any string handling.
+
+TIMESTAMP_ISO = 'iso'
+TIMESTAMP_DATETIME = 'datetime'
+TIMESTAMP_EPOCH = 'epoch'
+
+
+def format_timestamp(dt, fmt=TIMESTAMP_ISO):
+    """ Encodes a naive UTC datetime for storage in the given format. """
+    if fmt == TIMESTAMP_ISO:
+        return dt.isoformat()+'Z'
+    elif fmt == TIMESTAMP_DATETIME:
+        return dt.replace(microsecond=dt.microsecond // 1000 * 1000)
+    elif fmt == TIMESTAMP_EPOCH:
+        return calendar.timegm(dt.utctimetuple())*1000 + dt.microsecond//1000
+    raise ValueError("unknown timestamp format %s" % fmt)
+
+
+def parse_timestamp(value, tzinfo=local_timezone):
+    """ Decodes a stored timestamp in any of the storage formats. Returns a
+        naive datetime object after first converting to tzinfo, like
+        parse_iso_datetime. """
+    if isinstance(value, basestring):
+        return parse_iso_datetime(value, tzinfo)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo:
+            value = value.astimezone(utc_timezone).replace(tzinfo=None)
+        return _from_utc(value, tzinfo)
+    dt = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=value)
+    return _from_utc(dt, tzinfo)
+
+
 def format_iso(dt, default_tzinfo=local_timezone):
     """ Creates an UTC timezone string in iso format from the given datetime
         (with trailing 'Z'). If no tzinfo is set on the passed datetime,
@@ -0,0 +1,296 @@
+__all__ = ['WriteBehindBuffer']
+
+import atexit
+import os
+import threading
+
+from copy import deepcopy
+from time import time
+
+from utils import metricutils
+
+
+## PENDING OPERATIONS ---------------------------------------------------------
+#
+# Each pending id has one operation, either ('save', data, None) to store a
+# whole document or ('update', sets, unsets) to change some of its fields.
+# A newer operation on the same id is merged into the older one.
+
+def _combine(old, new):
+    '''
+    Returns the single operation equivalent to old followed by new.
+    '''
+    if old is None:
+        return new
+    if new is None or new[0] == 'save':
+        return new or old
+    sets, unsets = new[1], new[2]
+    if old[0] == 'save':
+        return 'save', _apply(new, old[1]), None
+    merged = dict(old[1])
+    merged.update(sets)
+    for key in unsets:
+        merged.pop(key, None)
+    return 'update', merged, (old[2] - set(sets)) | unsets
+
+
+def _apply(op, data):
+    '''
+    Returns a copy of data (a stored document or None) with op applied.
+    '''
+    if op is None:
+        return data
+    if op[0] == 'save':
+        return deepcopy(op[1])
+    if data is None:
+        return None
+    data = dict(data)
+    data.update(deepcopy(op[1]))
+    for key in op[2]:
+        data.pop(key, None)
+    return data
+
+
+## BUFFER ---------------------------------------------------------------------
+
+class WriteBehindBuffer(object):
+    '''
+    Holds a collection's saves and writes them to its backend in bulk, from
+    a background thread, once maxPending ids are waiting or every
+    flushInterval seconds. Repeated saves of the same id are merged into
+    one write. See Collection.setWriteBehind.
+
+    Reads by id look at the pending writes first, so they see every save.
+    Pending writes are flushed when the process exits. If a flush fails its
+    writes are kept, to be tried again by the next one.
+    '''
+
+    def __init__(self, backend, maxPending=1000, flushInterval=1.0,
+                 name=None):
+        self.backend = backend
+        self.maxPending = maxPending
+        self.flushInterval = flushInterval
+        self.name = name or backend.colName
+        self.lock = threading.Lock()
+        self.flushLock = threading.RLock()
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+        self._reset()
+        atexit.register(self.close)
+
+
+    def _reset(self):
+        # also used after a fork: the parent flushes its own pending writes
+        self.pid = os.getpid()
+        self.pending = {}
+        self.flushing = {}
+        self.thread = None
+        self.flushes = 0
+        self.writes = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.lastError = None
+        self.lastFlushLatency = None
+        self.maxFlushLatency = 0.0
+
+
+    def _start(self):
+        # called holding the lock
+        if self.pid != os.getpid():
+            self._reset()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run,
+                                           name='writebehind-%s' % self.name)
+            self.thread.daemon = True
+            self.thread.start()
+
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.closed:
+                    return
+                self.wakeup.wait(self.flushInterval)
+            try:
+                self.flush()
+            except Exception:
+                # recorded in errors and lastError, retried next time
+                pass
+
+
+    def _enqueue(self, modelId, op):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("write behind buffer for %s is closed" %
+                                   self.name)
+            self._start()
+            old = self.pending.get(modelId)
+            if old is not None:
+                self.coalesced += 1
+            self.pending[modelId] = _combine(old, op)
+            waiting = len(self.pending)
+            if waiting >= self.maxPending:
+                self.wakeup.notify()
+        if waiting >= 2 * self.maxPending:
+            # the background thread isn't keeping up, push back on the caller
+            self.flush()
+
+
+    def _pendingOp(self, modelId):
+        with self.lock:
+            return _combine(self.flushing.get(modelId),
+                            self.pending.get(modelId))
+
+
+    # Writes -----------------------
+
+    def save(self, model):
+        data = deepcopy(dict(model))
+        self._enqueue(data['id'], ('save', data, None))
+        return data['id']
+
+
+    def saveMany(self, models):
+        return [self.save(model) for model in models]
+
+
+    def update(self, modelId, sets, unsets=None):
+        sets = deepcopy(dict((k, v) for k, v in sets.iteritems() if k != 'id'))
+        self._enqueue(modelId, ('update', sets, set(unsets or ())))
+
+
+    def updateMany(self, updates):
+        for modelId, sets, unsets in updates:
+            self.update(modelId, sets, unsets)
+
+
+    def delete(self, model):
+        '''
+        Drops any pending write of model and deletes it from the backend
+        straight away.
+        '''
+        with self.flushLock:
+            with self.lock:
+                self.pending.pop(model['id'], None)
+            return self.backend.delete(model)
+
+
+    # Reads -----------------------
+
+    def getItem(self, modelId):
+        op = self._pendingOp(modelId)
+        if op is not None and op[0] == 'save':
+            return _apply(op, None)
+        return _apply(op, self.backend.getItem(modelId))
+
+
+    def getItems(self, modelIds, fields=None):
+        ops = dict((modelId, self._pendingOp(modelId)) for modelId in modelIds)
+        stored = [modelId for modelId, op in ops.iteritems()
+                  if op is None or op[0] != 'save']
+        result = self.backend.getItems(stored, fields=fields) if stored \
+                 else {}
+        for modelId, op in ops.iteritems():
+            if op is None:
+                continue
+            data = _apply(op, result.get(modelId))
+            if data is None:
+                continue
+            if fields is not None:
+                data = dict((k, v) for k, v in data.iteritems() if k in fields)
+            result[modelId] = data
+        return result
+
+
+    def exists(self, modelIds):
+        found = set()
+        stored = []
+        for modelId in modelIds:
+            op = self._pendingOp(modelId)
+            if op is not None and op[0] == 'save':
+                found.add(modelId)
+            else:
+                stored.append(modelId)
+        if stored:
+            found |= self.backend.exists(stored)
+        return found
+
+
+    # Flushing -----------------------
+
+    def flush(self):
+        '''
+        Writes every pending operation to the backend. Returns the number
+        of ids written. Raises the backend's error if writing fails, in
+        which case the operations stay pending.
+        '''
+        with self.flushLock:
+            with self.lock:
+                if self.pid != os.getpid():
+                    self._reset()
+                if not self.pending:
+                    return 0
+                ops = self.flushing = self.pending
+                self.pending = {}
+
+            start = time()
+            try:
+                saves = [op[1] for op in ops.itervalues() if op[0] == 'save']
+                if saves:
+                    self.backend.saveMany(saves)
+                updates = [(modelId, op[1], list(op[2]))
+                           for modelId, op in ops.iteritems()
+                           if op[0] == 'update']
+                if updates:
+                    self.backend.updateMany(updates)
+            except Exception as e:
+                with self.lock:
+                    for modelId, op in ops.iteritems():
+                        self.pending[modelId] = _combine(
+                            op, self.pending.get(modelId))
+                    self.flushing = {}
+                    self.errors += 1
+                    self.lastError = e
+                raise
+            latency = time() - start
+
+            with self.lock:
+                self.flushing = {}
+                self.flushes += 1
+                self.writes += len(ops)
+                self.lastFlushLatency = latency
+                self.maxFlushLatency = max(self.maxFlushLatency, latency)
+            if metricutils.sinks:
+                metricutils.emit('writeBehindFlush', self.name, latency,
+                                 len(ops))
+            return len(ops)
+
+
+    def close(self):
+        '''
+        Stops the background thread and flushes the pending writes.
+        '''
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+            thread = self.thread
+        if self.pid != os.getpid():
+            return
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+
+    def stats(self):
+        '''
+        Returns the number of ids waiting to be written (pending), and
+        counts of flushes, ids written, saves merged into a pending write
+        and failed flushes, with the flush latencies in seconds.
+        '''
+        with self.lock:
+            return dict(pending=len(self.pending) + len(self.flushing),
+                        flushes=self.flushes, writes=self.writes,
+                        coalesced=self.coalesced, errors=self.errors,
+                        lastError=self.lastError,
+                        lastFlushLatency=self.lastFlushLatency,
+                        maxFlushLatency=self.maxFlushLatency)
@@ -1,5 +1,9 @@
 import os
-from distutils.core import setup
+try:
+    from setuptools import setup
+except ImportError:
+    # distutils ignores install_requires and extras_require
+    from distutils.core import setup
 
 root = os.path.dirname(os.path.realpath(__file__))
 
@@ -11,6 +15,7 @@ setup(
     description='Python document based persistence inspired by backbone.js with dict and object syntax.',
     packages=['quickdata'],
     install_requires=open(root+"/requirements.txt").read().splitlines(),
+    extras_require={'async': ['trollius']},
     long_description=open(root+"/README.md").read(),
     license='LICENSE',
 )
\ No newline at end of file